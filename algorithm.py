@@ -1,4 +1,4 @@
-
+import logging
 from math import pow, log2, e
 
 '''
@@ -8,6 +8,32 @@ This file includes the implementation of the spaced-repetition algorithm by Davi
 @date January/February/March 2023
 '''
 
+logger = logging.getLogger(__name__)
+
+# The constants of the algorithm, in the order they are stored in the db (see optimizer.py for fitting them)
+DEFAULT_PARAMETERS = (
+    0.2,     # mean reversion rate of the difficulty
+    3.81,    # successful recall: exponent of e
+    0.73,    # successful recall: base of the difficulty factor
+    -0.127,  # successful recall: exponent of the stability
+    0.970,   # successful recall: exponent of 1 - R
+    -0.041,  # failure of recall: exponent of e
+    -0.041,  # failure of recall: exponent of the difficulty
+    0.377,   # failure of recall: exponent of the stability
+    -0.227,  # failure of recall: exponent of 1 - R
+)
+# the parameters used when none are passed explicitly
+active_parameters = DEFAULT_PARAMETERS
+
+
+def use_parameters(parameters):
+    """Uses the fitted parameters (as returned by db.get_parameters) when none are passed explicitly. Keeps the
+    current ones if parameters is None, i.e. they were never fitted"""
+    global active_parameters
+    if parameters is not None:
+        logger.info("Using the fitted parameters %s", parameters)
+        active_parameters = parameters
+
 
 def pow_z(x, y):
     """Catches the edge case 'zero to the power of y', which throws a RangeError when using math.pow"""
@@ -16,27 +42,97 @@ def pow_z(x, y):
     return pow(x, y)
 
 
-def calculate_stability_difficulty(s_i, delta_t, d_i, grade, new_card=False):
+def next_state(s_i, r, d_i, grade, w):
+    """The new stability (not rounded yet) and difficulty after a review with the grade at the retrievability r"""
+    d_i_p1 = d_i + 3 - grade + w[0] * (2 - d_i + grade)
+    if grade == 1:  # failure of recall
+        s_i_p1 = pow_z(e, w[5]) * pow_z(d_i_p1, w[6]) * pow_z(s_i, w[7]) * pow_z(1-r, w[8])
+    else:  # Other grade = successful recall
+        s_i_p1 = s_i * (pow_z(e, w[1]) * pow_z(w[2], d_i_p1-1) * pow_z(s_i / -log2(0.9), w[3]) * pow_z(1-r, w[4]) + 1)
+    return s_i_p1, d_i_p1
+
+
+def calculate_stability_difficulty(s_i, delta_t, d_i, grade, new_card=False, parameters=None):
     """Calculates the new stability and difficulty according to the pre-defined algorithm (see algorithm.pdf for details)"""
     if grade > 4 or grade < 1:
         raise Exception("Grade out of bounds")
-    mean_reversion_rate = 0.2
+    w = parameters or active_parameters
+    # this runs for every review, the messages are only formatted when debugging
+    debug = logger.isEnabledFor(logging.DEBUG)
 
     # if the card is new, we need to set the previous values as defined in the algorithm
     if new_card:
         s_i = 1
         d_i = 5 + 3 - grade
-        print(f"[D] New card => s0 = {s_i}, d0 = {d_i}")
+        if debug:
+            logger.debug("New card => s0 = %s, d0 = %s", s_i, d_i)
+
+    # 0 / 0 for a card with a stability of 0 that is studied again on the same day, like in next_state_batch
+    r = pow_z(0.9, (delta_t / s_i)) if s_i else 0.0
+    s_i_p1, d_i_p1 = next_state(s_i, r, d_i, grade, w)
+    if debug:
+        logger.debug("R = %s, d_i+1 = %s, s_i+1 = %s", r, d_i_p1, s_i_p1)
+    return int(round(s_i_p1)), d_i_p1
+
+
+def calculate_all_grades(s_i, delta_t, d_i, new_card=False, parameters=None):
+    """Calculates what each grade would do to the card at once, the retrievability is the same for all of them. Returns
+    the new (stability, difficulty) for the grades 1 to 4, the same as calculate_stability_difficulty returns for each"""
+    w = parameters or active_parameters
+    if new_card:
+        s_i = 1
+    r = pow_z(0.9, (delta_t / s_i)) if s_i else 0.0
+    outcomes = []
+    for grade in (1, 2, 3, 4):
+        s_i_p1, d_i_p1 = next_state(s_i, r, 5 + 3 - grade if new_card else d_i, grade, w)
+        outcomes.append((int(round(s_i_p1)), d_i_p1))
+    return outcomes
+
+
+def pow_z_batch(x, y):
+    """pow_z for NumPy arrays"""
+    import numpy as np
+    with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+        return np.where((x == 0) & (y != 0), 0.0, np.power(x, y))
+
+
+def next_state_batch(s_i, delta_t, d_i, grade, new_card, parameters=None):
+    """The unrounded core of calculate_stability_difficulty_batch. Returns the retrievability at the time of the review
+    and the new stabilities and difficulties. Every parameter can also be an array, e.g. of shape (n, 1) to evaluate n
+    sets of parameters at once"""
+    import numpy as np
+    s_i = np.asarray(s_i, dtype=np.float64)
+    delta_t = np.asarray(delta_t, dtype=np.float64)
+    d_i = np.asarray(d_i, dtype=np.float64)
+    grade = np.asarray(grade, dtype=np.int64)
+    new_card = np.asarray(new_card, dtype=bool)
+    if np.any((grade > 4) | (grade < 1)):
+        raise Exception("Grade out of bounds")
+    w = parameters or active_parameters
+    mean_reversion_rate = w[0]
 
-    r = pow_z(0.9, (delta_t / s_i))
-    print(f"[D] R = {r}")
+    # new cards start with the values defined in the algorithm, whatever was passed for them
+    s_i = np.where(new_card, 1.0, s_i)
+    d_i = np.where(new_card, 5 + 3 - grade, d_i)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        # 0 / 0 for a card with a stability of 0 that is studied again on the same day
+        r = np.where(s_i == 0, 0.0, pow_z_batch(0.9, delta_t / s_i))
 
     d_i_p1 = d_i + 3 - grade + mean_reversion_rate * (2 - d_i + grade)
-    print(f"[D] d_i+1 = {d_i_p1}")
-    if grade == 1:  # failure of recall
-        s_i_p1 = pow_z(e, -0.041) * pow_z(d_i_p1, -0.041) * pow_z(s_i, 0.377) * pow_z(1-r, -0.227)
-        print(f"[D] s_i+1 = sf = {s_i_p1}")
-    else:  # Other grade = successful recall
-        s_i_p1 = s_i * (pow_z(e, 3.81) * pow_z(0.73, d_i_p1-1) * pow_z(s_i / -log2(0.9), -0.127) * pow_z(1-r, 0.970) + 1)
-        print(f"[D] s_i+1 = {s_i_p1}")
-    return int(round(s_i_p1)), d_i_p1
+    # both cases are calculated for all cards, every card then picks the one for its grade
+    s_fail = pow_z_batch(e, w[5]) * pow_z_batch(d_i_p1, w[6]) * pow_z_batch(s_i, w[7]) * pow_z_batch(1-r, w[8])
+    s_success = s_i * (pow_z_batch(e, w[1]) * pow_z_batch(w[2], d_i_p1-1) * pow_z_batch(s_i / -log2(0.9), w[3])
+                       * pow_z_batch(1-r, w[4]) + 1)
+    return r, np.where(grade == 1, s_fail, s_success), d_i_p1
+
+
+def calculate_stability_difficulty_batch(s_i, delta_t, d_i, grade, new_card, parameters=None):
+    """Calculates the new stabilities and difficulties of many cards at once. Takes NumPy arrays (or anything NumPy can
+    turn into one) of the same shape and returns the arrays of the new stabilities (rounded like the scalar version)
+    and difficulties. Performs exactly the same operations as calculate_stability_difficulty, so both give the same
+    results, a stability of 0 results in a retrievability of 0 in both"""
+    import numpy as np
+    _, s_i_p1, d_i_p1 = next_state_batch(s_i, delta_t, d_i, grade, new_card, parameters)
+    # np.rint rounds half to even, just like round
+    return np.rint(s_i_p1).astype(np.int64), d_i_p1
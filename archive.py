@@ -0,0 +1,266 @@
+import json
+import logging
+import os
+import shutil
+import struct
+import tempfile
+import time
+import zipfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import db
+
+'''
+This file exports the db and the attachments into a zip archive and imports them again.
+
+Besides the full archives, there are delta archives holding only what changed since the last export (see
+db.create_change_journal), as delta.json and the attached files the changed cards need. Importing one merges the changes
+into the db instead of replacing it.
+
+The db is exported from a snapshot taken with SQLite's online backup, so it's consistent even if it's written to at the
+same time. Taking it is the only part of an export that uses the db, the files are compressed and written on another
+thread. They're deflated on a pool of threads (zlib releases the GIL while compressing) into temporary files, which are
+then appended to the archive as they're done. Formats that are compressed already, and files deflating doesn't make
+smaller, are stored as they are.
+'''
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1 << 20
+# the name of the file holding the changes in a delta archive
+DELTA_NAME = "delta.json"
+# deflating these doesn't make them any smaller
+COMPRESSED_EXTENSIONS = {
+    ".jpg", ".jpeg", ".png", ".gif", ".webp", ".heic",
+    ".mp3", ".m4a", ".aac", ".ogg", ".opus", ".flac",
+    ".mp4", ".m4v", ".mov", ".mkv", ".webm",
+    ".zip", ".gz", ".bz2", ".xz", ".7z", ".rar",
+    ".docx", ".xlsx", ".pptx", ".odt", ".ods", ".epub",
+}
+
+# the records of the zip format
+LOCAL_HEADER = struct.Struct("<4s5H3L2H")
+CENTRAL_HEADER = struct.Struct("<4s6H3L5H2L")
+END_RECORD = struct.Struct("<4s4H2LH")
+ZIP64_END_RECORD = struct.Struct("<4sQ2H2L4Q")
+ZIP64_END_LOCATOR = struct.Struct("<4sLQL")
+# sizes and offsets above this are written into zip64 fields, like zipfile does (some readers take 32 bits as signed)
+ZIP64_LIMIT = (1 << 31) - 1
+
+
+def is_compressed(file_name):
+    return os.path.splitext(file_name)[1].lower() in COMPRESSED_EXTENSIONS
+
+
+class Entry:
+    """A file as it's written into an archive, its data (deflated or as it is) is in data_file"""
+    __slots__ = ("arcname", "data_file", "method", "crc", "compress_size", "file_size", "mtime", "mode", "offset")
+
+    def __init__(self, arcname, source_file):
+        stat = os.stat(source_file)
+        self.arcname = arcname
+        self.data_file = source_file
+        self.method = zipfile.ZIP_STORED
+        self.crc = 0
+        self.compress_size = self.file_size = stat.st_size
+        self.mtime = stat.st_mtime
+        self.mode = stat.st_mode
+        self.offset = 0
+
+    def dos_date_time(self):
+        year, month, day, hour, minute, second = time.localtime(self.mtime)[:6]
+        if year < 1980:
+            # the earliest date a zip archive can hold
+            year, month, day, hour, minute, second = 1980, 1, 1, 0, 0, 0
+        return hour << 11 | minute << 5 | second // 2, (year - 1980) << 9 | month << 5 | day
+
+    def header_fields(self):
+        """Returns the version needed to extract the entry, its flags and name, and its zip64 extra field (for the
+        central directory, which has the offset in it as well)"""
+        name = self.arcname.encode()
+        # bit 11: the name is UTF-8
+        flags = 0 if self.arcname.isascii() else 0x800
+        large = [value for value in (self.file_size, self.compress_size, self.offset) if value > ZIP64_LIMIT]
+        extra = struct.pack(f"<2H{len(large)}Q", 1, 8 * len(large), *large) if large else b""
+        return 45 if large else 20, flags, name, extra
+
+
+def prepare(arcname, source_file, temporary_dir):
+    """Deflates the file into a temporary file in chunks and computes its CRC on the way. Formats that are compressed
+    already, and files that deflating doesn't make smaller, are stored as they are. Returns the Entry"""
+    entry = Entry(arcname, source_file)
+    crc = 0
+    if is_compressed(arcname):
+        with open(source_file, "rb") as source:
+            while chunk := source.read(CHUNK_SIZE):
+                crc = zlib.crc32(chunk, crc)
+        entry.crc = crc
+        return entry
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+    file_size = 0
+    fd, temporary = tempfile.mkstemp(dir=temporary_dir, suffix=".deflate")
+    with os.fdopen(fd, "wb") as target, open(source_file, "rb") as source:
+        while chunk := source.read(CHUNK_SIZE):
+            crc = zlib.crc32(chunk, crc)
+            file_size += len(chunk)
+            target.write(compressor.compress(chunk))
+        target.write(compressor.flush())
+        compress_size = target.tell()
+    entry.crc, entry.file_size = crc, file_size
+    if compress_size < file_size:
+        entry.data_file, entry.method, entry.compress_size = temporary, zipfile.ZIP_DEFLATED, compress_size
+    else:
+        entry.compress_size = file_size
+        os.remove(temporary)
+    return entry
+
+
+class ArchiveWriter:
+    """Writes a zip archive entry by entry, the data of every entry is copied as it is. zipfile can only compress data
+    itself, so the records are written here (following PKWARE's APPNOTE.TXT)"""
+
+    def __init__(self, file):
+        self.file = file
+        self.entries = []
+
+    def write(self, entry):
+        entry.offset = self.file.tell()
+        version, flags, name, _ = entry.header_fields()
+        sizes = (entry.compress_size, entry.file_size)
+        if max(sizes) > ZIP64_LIMIT:
+            # the local header always has both sizes in its zip64 field, but never the offset
+            extra = struct.pack("<2H2Q", 1, 16, entry.file_size, entry.compress_size)
+            sizes = (0xFFFFFFFF, 0xFFFFFFFF)
+        else:
+            extra = b""
+        self.file.write(LOCAL_HEADER.pack(b"PK\x03\x04", version, flags, entry.method, *entry.dos_date_time(),
+                                          entry.crc, *sizes, len(name), len(extra)))
+        self.file.write(name + extra)
+        with open(entry.data_file, "rb") as source:
+            shutil.copyfileobj(source, self.file, CHUNK_SIZE)
+        self.entries.append(entry)
+
+    def close(self):
+        """Writes the central directory, the archive is complete afterwards"""
+        start = self.file.tell()
+        for entry in self.entries:
+            version, flags, name, extra = entry.header_fields()
+            compress_size, file_size, offset = (value if value <= ZIP64_LIMIT else 0xFFFFFFFF
+                                                for value in (entry.compress_size, entry.file_size, entry.offset))
+            # made by: 3 for unix, which the permissions in the external attributes are from
+            self.file.write(CENTRAL_HEADER.pack(b"PK\x01\x02", 3 << 8 | version, version, flags, entry.method,
+                                                *entry.dos_date_time(), entry.crc, compress_size, file_size,
+                                                len(name), len(extra), 0, 0, 0, (entry.mode & 0xFFFF) << 16, offset))
+            self.file.write(name + extra)
+        end = self.file.tell()
+        count, size, offset = len(self.entries), end - start, start
+        if count >= 0xFFFF or size > ZIP64_LIMIT or offset > ZIP64_LIMIT:
+            self.file.write(ZIP64_END_RECORD.pack(b"PK\x06\x06", ZIP64_END_RECORD.size - 12, 45, 45, 0, 0,
+                                                  count, count, size, offset))
+            self.file.write(ZIP64_END_LOCATOR.pack(b"PK\x06\x07", 0, end, 1))
+            count, size, offset = min(count, 0xFFFF), min(size, 0xFFFFFFFF), min(offset, 0xFFFFFFFF)
+        self.file.write(END_RECORD.pack(b"PK\x05\x06", 0, 0, count, count, size, offset, 0))
+
+
+def write_archive(zip_file_name, files, temporary_dir, max_workers=None):
+    """Writes the files, given as (name in the archive, path) tuples, into a new archive. Doesn't touch the db"""
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="export") as executor, \
+            open(zip_file_name, "wb") as file:
+        archive_writer = ArchiveWriter(file)
+        futures = [executor.submit(prepare, arcname, path, temporary_dir) for arcname, path in files]
+        for future in as_completed(futures):
+            entry = future.result()
+            archive_writer.write(entry)
+            if entry.method == zipfile.ZIP_DEFLATED:
+                os.remove(entry.data_file)
+        archive_writer.close()
+
+
+def attachment_files(file_names):
+    return [(file_name, os.path.join(db.get_data_dir(), file_name)) for file_name in file_names]
+
+
+def call(fn, *args):
+    """Runs the db calls of an export on the calling thread, for the command line and the benchmark"""
+    return fn(*args)
+
+
+def take_snapshot(snapshot_file):
+    """Backs the db up into the file. Returns the sequence number of the last change in it and the attached files the
+    cards use"""
+    seq = db.get_change_seq()
+    db.backup(snapshot_file)
+    return seq, db.get_attachment_names()
+
+
+def collect_changes(since):
+    """Returns everything that changed since the sequence number since (by default, since the last export)"""
+    if since is None:
+        since = db.get_exported_seq()
+    changes = db.get_changes(since)
+    changes["since"], changes["until"] = since, db.get_change_seq()
+    return changes
+
+
+def export_archive(zip_file_name, max_workers=None, run=call):
+    """Writes the db and all attachments into a zip archive.
+
+    The db is only used by the calls made through run(fn, *args), the app passes Worker.call so they run on the worker,
+    while the files are compressed and written on the calling thread. Everything else queued on the worker doesn't have
+    to wait for the export that way"""
+    with tempfile.TemporaryDirectory() as temporary_dir:
+        snapshot = os.path.join(temporary_dir, db.db_name)
+        seq, file_names = run(take_snapshot, snapshot)
+        # only the files the cards use
+        files = [(db.db_name, snapshot)] + attachment_files(file_names)
+        write_archive(zip_file_name, files, temporary_dir, max_workers)
+    # the next delta starts from here
+    run(db.set_exported_seq, seq)
+    logger.info("Exported %s files to %s", len(files), zip_file_name)
+
+
+def export_delta(zip_file_name, since=None, max_workers=None, run=call):
+    """Writes everything that changed since the sequence number since (by default, since the last export) into a delta
+    archive, the db calls are made through run like in export_archive. Returns the number of changed decks and cards"""
+    changes = run(collect_changes, since)
+    with tempfile.TemporaryDirectory() as temporary_dir:
+        delta_file = os.path.join(temporary_dir, DELTA_NAME)
+        with open(delta_file, "w") as file:
+            json.dump(changes, file)
+        write_archive(zip_file_name, [(DELTA_NAME, delta_file)] + attachment_files(changes["attachments"]),
+                      temporary_dir, max_workers)
+    run(db.set_exported_seq, changes["until"])
+    changed = sum(len(changes[key]) for key in ("decks", "cards", "deleted_decks", "deleted_cards"))
+    logger.info("Exported %s changes since %s to %s", changed, changes["since"], zip_file_name)
+    return changed
+
+
+def import_delta(zip_archive):
+    """Merges the changes of a delta archive into the db"""
+    changes = json.loads(zip_archive.read(DELTA_NAME))
+    # the files are stored under their content's hash, a file that's already there doesn't need to be extracted again
+    for file_name in changes["attachments"]:
+        if not os.path.exists(os.path.join(db.get_data_dir(), file_name)):
+            zip_archive.extract(file_name, db.get_data_dir())
+    db.apply_changes(changes)
+    logger.info("Imported the changes %s to %s", changes["since"], changes["until"])
+
+
+def import_archive(zip_file_name):
+    """Runs on the worker. Replaces the db and all attachments with the ones from the archive, or merges the changes of a
+    delta archive into them. Returns False if the archive contains neither a db nor changes"""
+    with zipfile.ZipFile(zip_file_name, "r") as zip_archive:
+        if DELTA_NAME in zip_archive.namelist():
+            import_delta(zip_archive)
+            return True
+        if db.db_name not in zip_archive.namelist():
+            return False
+        db.close()
+        try:
+            # extract the archive
+            zip_archive.extractall(db.get_data_dir())
+        finally:
+            # re-open the connection
+            db.connect_DB()
+    return True
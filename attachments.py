@@ -0,0 +1,60 @@
+import hashlib
+import os
+import shutil
+import tempfile
+
+import db
+
+'''
+This file stores the files attached to cards.
+
+Every file is stored under the hash of its content, so a file attached to several cards is only stored once. Which
+cards use which file is counted in the db (see db.create_attachments), and a file is only removed once no card uses it
+anymore (see db.remove_unreferenced_attachments). Nothing in here touches the db, so files can be hashed and copied on
+any thread.
+'''
+
+# the folder in the app data directory that holds the files
+ATTACHMENTS_DIR = "attachments"
+CHUNK_SIZE = 1 << 20
+
+
+def hash_file(path):
+    """Returns the SHA-256 of the file's content, read in chunks so large files never have to be in memory"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        while chunk := file.read(CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def file_name(source_file):
+    """Returns the name the file is stored under, relative to the app data directory. The extension is kept, so the
+    file still opens with the right application"""
+    extension = os.path.splitext(source_file)[1].lower()
+    # always with a forward slash, the names are also used in exported archives
+    return f"{ATTACHMENTS_DIR}/{hash_file(source_file)}{extension}"
+
+
+def path(name):
+    """Returns the full path of a stored file"""
+    return os.path.join(db.get_data_dir(), name)
+
+
+def store(source_file, name=None):
+    """Copies the file into the store unless a file with the same content is already there. Returns its name"""
+    name = name or file_name(source_file)
+    destination = path(name)
+    if os.path.exists(destination):
+        return name
+    os.makedirs(os.path.dirname(destination), exist_ok=True)
+    # copy to a temporary file first and only then move it into place, so a half-copied file never has a valid name
+    fd, temporary = tempfile.mkstemp(dir=os.path.dirname(destination), suffix=".part")
+    try:
+        with os.fdopen(fd, "wb") as target, open(source_file, "rb") as source:
+            shutil.copyfileobj(source, target, CHUNK_SIZE)
+        os.replace(temporary, destination)
+    except BaseException:
+        os.remove(temporary)
+        raise
+    return name
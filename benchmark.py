@@ -0,0 +1,231 @@
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+
+import algorithm
+import db
+
+'''
+This file measures how fast the db and the algorithm are on synthetic collections.
+
+A collection is a tree of decks (depth levels with fan_out child decks each) with the same number of cards in every
+deck, of which a given share is due, and optionally files attached to them. It's generated in a temporary directory,
+the timings of the hot paths are written as JSON, and two of those files can be compared to spot regressions:
+
+    python benchmark.py --output before.json
+    (change something)
+    python benchmark.py --output after.json --compare before.json
+'''
+
+
+def deck_names(depth, fan_out):
+    """Returns the (name, parent) of every deck of the tree, parents first"""
+    decks = []
+    level = [None]
+    for _ in range(depth):
+        next_level = []
+        for parent in level:
+            for i in range(fan_out):
+                name = f"{parent}_{i}" if parent else f"deck_{i}"
+                decks.append((name, parent))
+                next_level.append(name)
+        level = next_level
+    return decks
+
+
+def generate_collection(depth=3, fan_out=4, cards_per_deck=50, due_ratio=0.3, attachments=0, attachment_size=0,
+                        seed=0):
+    """Fills the connected (empty) db with a synthetic collection. Returns the decks as (name, parent) tuples"""
+    import attachments as attachment_store
+    rng = random.Random(seed)
+    decks = deck_names(depth, fan_out)
+
+    file_names = []
+    if attachments:
+        with tempfile.TemporaryDirectory() as source_dir:
+            for i in range(attachments):
+                source_file = os.path.join(source_dir, f"score_{i}.pdf")
+                with open(source_file, "wb") as file:
+                    file.write(rng.randbytes(attachment_size))
+                file_names.append(attachment_store.store(source_file))
+
+    cards = []
+    schedules = []
+    today = db.today()
+    for name, _ in decks:
+        for i in range(cards_per_deck):
+            cards.append((name, f"{name}_card_{i}", rng.choice(file_names) if file_names else None))
+            stability = rng.randint(1, 60)
+            due_in = -rng.randint(0, stability) if rng.random() < due_ratio else rng.randint(1, stability)
+            # the cards get their ids in the order they're added, starting at 1 in the empty db
+            schedules.append((len(cards), today + due_in, stability, rng.uniform(1, 10)))
+    with db.transaction():
+        db.add_decks(decks)
+        db.add_cards(cards)
+        db.set_schedules(schedules)
+    return decks
+
+
+def measure(fn, repeat, setup=None):
+    """Runs fn repeat times (after setup, which isn't timed) and returns the statistics of the durations in ms"""
+    durations = []
+    for _ in range(repeat):
+        argument = setup() if setup is not None else None
+        start = time.perf_counter()
+        fn() if setup is None else fn(argument)
+        durations.append((time.perf_counter() - start) * 1000)
+    return {
+        "runs": repeat,
+        "min_ms": round(min(durations), 3),
+        "median_ms": round(statistics.median(durations), 3),
+        "mean_ms": round(statistics.mean(durations), 3),
+    }
+
+
+def run_benchmarks(decks, repeat=5, reviews=1000):
+    """Times the hot paths on the collection in the connected db. Returns the results by name"""
+    import archive
+    import studyqueue
+    results = dict()
+    top_level = db.get_deck_id(decks[0][0])
+    leaf = db.get_deck_id(decks[-1][0])
+
+    results["get_decks"] = measure(db.get_decks, repeat)
+    results["get_deck_tree"] = measure(db.get_deck_tree, repeat)
+    results["get_child_decks"] = measure(db.get_child_decks, repeat)
+    results["get_cards_with_children"] = measure(lambda: db.get_cards(top_level), repeat)
+    results["get_cards_without_children"] = measure(lambda: db.get_cards(leaf, include_children_cards=False), repeat)
+    results["get_cards_only_due"] = measure(lambda: db.get_cards(top_level, only_due=True), repeat)
+    results["get_cards_all"] = measure(lambda: db.get_cards(None), repeat)
+
+    card_ids = [card.id for card in db.get_cards(top_level)][:reviews]
+    next_due_date = date.today() + timedelta(days=3)
+    results[f"update_card_after_review_x{len(card_ids)}"] = measure(
+        lambda: [db.update_card_after_review(card, 5.0, 3, next_due_date, 3, 2) for card in card_ids], repeat)
+
+    # every run spreads the same backlog, the cards are scheduled as generated again before it
+    generated_schedules = [(card.id, card.next_due_date, card.last_interval, card.last_difficulty)
+                           for card in db.get_cards(top_level)]
+    results["catch_up"] = measure(lambda _: studyqueue.catch_up(top_level, 7), repeat,
+                                  setup=lambda: db.set_schedules(generated_schedules))
+
+    # a top-level deck, all of its cards and child decks are renamed with it
+    names = [decks[0][0] + "_renamed", decks[0][0]]
+    results["rename_deck"] = measure(lambda: db.rename_deck(top_level, names[0]) and names.reverse(), repeat)
+    db.rename_deck(top_level, decks[0][0])
+
+    deck_names_by_id = {deck["id"]: deck["name"] for deck in db.get_decks()}
+
+    def copy_of_subtree():
+        """Adds a copy of the first top-level deck's subtree and returns the id of its root"""
+        suffix = f"_copy{time.perf_counter_ns()}"
+        subtree = [(name + suffix, parent + suffix if parent else None) for name, parent in decks
+                   if name.startswith(decks[0][0])]
+        cards = [(deck_names_by_id[card.deck_id] + suffix, card.title + suffix, card.filename)
+                 for card in db.get_cards(top_level)]
+        with db.transaction():
+            db.add_decks(subtree)
+            db.add_cards(cards)
+        return db.get_deck_id(subtree[0][0])
+    results["delete_deck"] = measure(db.delete_deck, repeat, setup=copy_of_subtree)
+
+    with tempfile.TemporaryDirectory() as export_dir:
+        zip_file_name = os.path.join(export_dir, "export.zip")
+        results["export_archive"] = measure(lambda: archive.export_archive(zip_file_name), repeat)
+        results["import_archive"] = measure(lambda: archive.import_archive(zip_file_name), repeat)
+
+    n = 10000
+    rng = random.Random(0)
+    states = [(rng.randint(1, 60), rng.randint(0, 90), rng.uniform(1, 10), rng.randint(1, 4)) for _ in range(n)]
+    results[f"calculate_stability_difficulty_x{n}"] = measure(
+        lambda: [algorithm.calculate_stability_difficulty(s, t, d, g) for s, t, d, g in states], repeat)
+    try:
+        import numpy as np
+    except ImportError:
+        pass
+    else:
+        s, t, d, g = (np.array(column) for column in zip(*states))
+        results[f"calculate_stability_difficulty_batch_x{n}"] = measure(
+            lambda: algorithm.calculate_stability_difficulty_batch(s, t, d, g, np.zeros(n, dtype=bool)), repeat)
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def compare(results, previous):
+    """Prints the change of every median compared to a previous run"""
+    for name, result in results.items():
+        if name in previous["results"]:
+            before, after = previous["results"][name]["median_ms"], result["median_ms"]
+            change = (after - before) / before if before else 0
+            print(f"{name:<45} {before:>10.2f} -> {after:>10.2f} ms  {change:+.0%}")
+        else:
+            print(f"{name:<45} {'':>10}    {result['median_ms']:>10.2f} ms  (new)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Times the db and the algorithm on a synthetic collection")
+    parser.add_argument("--depth", type=int, default=3, help="levels of decks")
+    parser.add_argument("--fan-out", type=int, default=4, help="child decks of every deck")
+    parser.add_argument("--cards", type=int, default=50, help="cards in every deck")
+    parser.add_argument("--due-ratio", type=float, default=0.3, help="share of the cards that are due")
+    parser.add_argument("--attachments", type=int, default=0, help="number of distinct attached files")
+    parser.add_argument("--attachment-size", type=int, default=100_000, help="size of every file in bytes")
+    parser.add_argument("--repeat", type=int, default=5, help="runs of every benchmark")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="file to write the results to, instead of stdout")
+    parser.add_argument("--compare", help="results of a previous run to compare to")
+    args = parser.parse_args()
+
+    config = {key: value for key, value in vars(args).items() if key not in ("output", "compare")}
+    data_dir = tempfile.mkdtemp(prefix="repetition-benchmark-")
+    db.data_dir = data_dir
+    try:
+        db.connect_DB()
+        start = time.perf_counter()
+        decks = generate_collection(args.depth, args.fan_out, args.cards, args.due_ratio, args.attachments,
+                                    args.attachment_size, args.seed)
+        generated_in = time.perf_counter() - start
+        results = run_benchmarks(decks, args.repeat)
+        db.close()
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+    output = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "sqlite": db.sqlite3.sqlite_version,
+        "platform": platform.platform(),
+        "config": config,
+        "collection": {"decks": len(decks), "cards": len(decks) * args.cards,
+                       "generated_in_ms": round(generated_in * 1000, 3)},
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(output, file, indent=2)
+    else:
+        json.dump(output, sys.stdout, indent=2)
+        print()
+    if args.compare:
+        with open(args.compare) as file:
+            compare(results, json.load(file))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,226 @@
+#! /usr/bin/python3
+
+import argparse
+import logging
+import os
+import sys
+
+import algorithm
+import db
+import logconfig
+
+'''
+This file is the command line entry point, for scripts and cron jobs as well as for studying in a terminal.
+
+Only db and algorithm are loaded up front, everything else (NumPy, the importer, Qt, ...) only once a command needs it,
+so a command like due starts without waiting for any of that.
+
+Usage:
+    python cli.py due [--deck DECK]
+    python cli.py gui
+    python cli.py --profile stats
+    python cli.py --help
+'''
+
+
+def deck_id(name):
+    """Returns the id of the deck with the name, or None (for all decks) if no name was given. Exits if there's no deck
+    with the name"""
+    if name is None:
+        return None
+    deck = db.get_deck_id(name)
+    if deck is None:
+        raise SystemExit(f"There is no deck named {name}")
+    return deck
+
+
+def print_deck_tree(decks, parent=None, depth=0):
+    for deck in decks:
+        if deck["parent_id"] == parent:
+            print(f"{'  ' * depth}{deck['name']}: {deck['due']} of {deck['total']} cards due")
+            print_deck_tree(decks, deck["id"], depth + 1)
+
+
+def due(args):
+    if args.deck is None:
+        print_deck_tree(db.get_deck_tree())
+    else:
+        for card in db.get_cards(deck_id(args.deck), only_due=True):
+            print(f"{card.title} (due {db.to_date(card.next_due_date)})")
+
+
+def stats(args):
+    decks = db.get_deck_tree()
+    grade_counts = db.get_grade_counts()
+    parameters = db.get_parameters()
+    top_level = [deck for deck in decks if deck["parent_id"] is None]
+    print(f"Decks: {len(decks)}")
+    print(f"Cards: {sum(deck['total'] for deck in top_level)}")
+    print(f"Due: {sum(deck['due'] for deck in top_level)}")
+    print(f"Reviews: {sum(grade_counts)}")
+    for name, count in zip(("Forgot", "Hard", "Good", "Easy"), grade_counts):
+        print(f"  {name}: {count} ({count / max(sum(grade_counts), 1):.0%})")
+    print(f"Parameters: {'fitted' if parameters else 'default'} {parameters or algorithm.DEFAULT_PARAMETERS}")
+
+
+def import_(args):
+    if args.path.lower().endswith(".zip"):
+        from archive import import_archive
+        if not import_archive(args.path):
+            print("The archive contains neither a db nor changes", file=sys.stderr)
+            return 1
+        print(f"Imported {args.path}")
+        return 0
+    import importer
+    if os.path.isdir(args.path):
+        entries = importer.read_folder(args.path, args.deck)
+    else:
+        entries = importer.read_manifest(args.path, args.deck)
+    print(importer.import_cards(entries))
+    return 0
+
+
+def export(args):
+    import archive
+    if args.changes or args.since is not None:
+        archive.export_delta(args.file, args.since)
+    else:
+        archive.export_archive(args.file)
+
+
+def reschedule(args):
+    import optimizer
+    print(f"Rescheduled {optimizer.reschedule(deck_id(args.deck))} cards")
+
+
+def optimize(args):
+    import optimizer
+    return 0 if optimizer.optimize() is not None else 1
+
+
+def forecast(args):
+    import simulate
+    print(simulate.forecast(deck_id(args.deck), days=args.days, runs=args.runs, seed=args.seed).table())
+
+
+def review(args):
+    import studyqueue
+    queue = studyqueue.StudyQueue(args.limit)
+    print(f"{queue.load(deck_id(args.deck))} cards due")
+    while True:
+        card, outcomes = queue.pop_with_outcomes()
+        if card is None:
+            break
+        print(f"\n{card.title}" + (f" ({card.filename})" if card.filename else ""))
+        # when the card would be due again for each grade
+        prompt = ", ".join(f"{grade} {name} ({outcomes[grade][2]})"
+                           for grade, name in enumerate(("Forgot", "Hard", "Good", "Easy"), start=1))
+        answer = ""
+        while answer not in ("1", "2", "3", "4", "q"):
+            answer = input(f"{prompt}, q Quit: ").strip().lower()
+        if answer == "q":
+            break
+        grade = int(answer)
+        stability, difficulty, next_due_date, delta_t = outcomes[grade]
+        db.update_card_after_review(card.id, difficulty, stability, next_due_date, grade, delta_t)
+        print(f"Due again at {next_due_date}")
+        if grade == 1:
+            queue.requeue(card.id)
+
+
+def catch_up(args):
+    import studyqueue
+    if args.days < 1:
+        raise SystemExit("--days has to be at least 1")
+    print(f"Spread {studyqueue.catch_up(deck_id(args.deck), args.days)} due cards over the next {args.days} days")
+
+
+def gui(args):
+    # the GUI connects on its own worker thread
+    db.close()
+    import main
+    return main.main()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Spaced repetition for musicians")
+    parser.add_argument("--data-dir", help="directory of the db and the attached files instead of the app's one")
+    parser.add_argument("-v", "--verbose", action="count", default=0,
+                        help="log what's done to stderr, -vv for debug messages as well")
+    parser.add_argument("--profile", action="store_true",
+                        help="measure the db's statements and print the statistics to stderr when done")
+    parser.add_argument("--slow-ms", type=float, default=100,
+                        help="with --profile, log statements slower than this (in ms) with their query plan")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    command = commands.add_parser("due", help="show the due cards of all decks, or those of one deck")
+    command.add_argument("--deck")
+    command.set_defaults(run=due)
+
+    command = commands.add_parser("stats", help="show statistics of the collection and the reviews")
+    command.set_defaults(run=stats)
+
+    command = commands.add_parser("import", help="import an archive, a CSV/JSON list of cards or a folder of files")
+    command.add_argument("path")
+    command.add_argument("--deck", help="deck for cards without one, parent deck of an imported folder")
+    command.set_defaults(run=import_)
+
+    command = commands.add_parser("export", help="export everything, or only the changes, into a zip archive")
+    command.add_argument("file")
+    command.add_argument("--changes", action="store_true", help="only export what changed since the last export")
+    command.add_argument("--since", type=int, help="only export what changed since this sequence number")
+    command.set_defaults(run=export)
+
+    command = commands.add_parser("reschedule", help="recalculate the schedules from the reviews (needs NumPy)")
+    command.add_argument("--deck")
+    command.set_defaults(run=reschedule)
+
+    command = commands.add_parser("optimize", help="fit the parameters to the reviews (needs NumPy)")
+    command.set_defaults(run=optimize)
+
+    command = commands.add_parser("forecast", help="simulate the reviews of the next days (needs NumPy)")
+    command.add_argument("--deck")
+    command.add_argument("--days", type=int, default=30)
+    command.add_argument("--runs", type=int, default=100)
+    command.add_argument("--seed", type=int)
+    command.set_defaults(run=forecast)
+
+    command = commands.add_parser("review", help="study the due cards of a deck in the terminal")
+    command.add_argument("deck")
+    command.add_argument("--limit", type=int, help="maximum number of cards")
+    command.set_defaults(run=review)
+
+    command = commands.add_parser("catch-up", help="spread the due cards of a deck over the next days, the ones "
+                                                   "most likely forgotten first")
+    command.add_argument("deck")
+    command.add_argument("--days", type=int, default=7)
+    command.set_defaults(run=catch_up)
+
+    command = commands.add_parser("gui", help="start the app")
+    command.set_defaults(run=gui)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logconfig.setup(level=(logging.WARNING, logging.INFO, logging.DEBUG)[min(args.verbose, 2)])
+    if args.data_dir is not None:
+        os.makedirs(args.data_dir, exist_ok=True)
+        db.data_dir = args.data_dir
+    if args.profile:
+        import instrumentation
+        instrumentation.enable(args.slow_ms)
+    db.connect_DB()
+    # the terminal schedules with the same parameters as the GUI
+    algorithm.use_parameters(db.get_parameters())
+    try:
+        return args.run(args) or 0
+    finally:
+        db.close()
+        if args.profile:
+            print(instrumentation.report(), file=sys.stderr)
+        logconfig.shutdown()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
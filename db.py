@@ -1,11 +1,28 @@
 import os
-from appdata import AppDataPaths
-from datetime import date
+import json
+import logging
+from contextlib import contextmanager
+from datetime import date, timedelta
 import sqlite3
 
-app_paths = AppDataPaths("repetition")
+# the directory holding the db and the attached files, the app's data directory unless it's set before connecting
+data_dir = None
 db_name = "cards.db"
 db = None
+# the class of the connection, instrumentation.enable() replaces it with one that measures every statement
+connection_factory = sqlite3.Connection
+# the number of nested transaction() blocks currently open
+transaction_depth = 0
+
+# Applied to every connection. WAL lets readers and the writer run concurrently and, together with synchronous=NORMAL,
+# makes a commit an append to the log that is only synced to disk at checkpoints instead of on every commit
+performance_pragmas = [
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA cache_size = -16000",   # 16 MB
+    "PRAGMA mmap_size = 268435456",  # 256 MB
+    "PRAGMA temp_store = MEMORY",
+]
 
 '''
 This file handles everything regarding the database, including connection, cards, and decks.
@@ -14,32 +31,172 @@ This file handles everything regarding the database, including connection, cards
 @date January/February/March 2023
 '''
 
+logger = logging.getLogger(__name__)
+
+# Dates are stored as day numbers, the days since this date, so comparing and subtracting them is integer arithmetic
+EPOCH = date(1970, 1, 1)
+# the julian day of EPOCH, to convert 'YYYY-MM-DD' strings in SQL
+EPOCH_JULIAN_DAY = 2440587.5
+
+
+def day_number(day):
+    return (day - EPOCH).days
+
+
+def to_date(day):
+    return EPOCH + timedelta(days=day)
+
+
+def today():
+    return day_number(date.today())
+
+
+class Card:
+    """A card as read from the db, holding only its values. A list of these takes a fraction of the memory of the same
+    rows as sqlite3.Row, the dates are day numbers"""
+    __slots__ = ("id", "title", "filename", "created_at", "next_due_date", "last_review", "last_difficulty",
+                 "last_interval", "deck_id")
+
+    def __init__(self, id, title, filename, created_at, next_due_date, last_review, last_difficulty, last_interval,
+                 deck_id):
+        self.id = id
+        self.title = title
+        self.filename = filename
+        self.created_at = created_at
+        self.next_due_date = next_due_date
+        # None for a card that was never studied
+        self.last_review = last_review
+        self.last_difficulty = last_difficulty
+        self.last_interval = last_interval
+        self.deck_id = deck_id
+
+
+# the columns to select for Card, in its order
+card_columns = ", ".join(Card.__slots__)
+
+
+def card_factory(cursor, row):
+    return Card(*row)
+
+
+def get_data_dir():
+    global data_dir
+    if data_dir is None:
+        # only loaded when needed, scripts passing their own directory don't have to pay for it
+        from appdata import AppDataPaths
+        app_paths = AppDataPaths("repetition")
+        if app_paths.require_setup:
+            app_paths.setup()
+        data_dir = app_paths.app_data_path
+    return data_dir
+
 
 def connect_DB():
-    """Connects to the db. If it is empty, the schema is created without any decks or cards"""
+    """Connects to the db. If it is empty, the schema is created without any decks or cards. Databases created by an
+    older version are upgraded to the current schema"""
     global db
     if db is not None:
         return
-    db = sqlite3.connect(os.path.join(app_paths.app_data_path, db_name))
+    db = sqlite3.connect(os.path.join(get_data_dir(), db_name), factory=connection_factory)
     db.execute("PRAGMA foreign_keys = ON;")
-    print("[I] Connected to DB")
+    for pragma in performance_pragmas:
+        db.execute(pragma)
+    logger.info("Connected to DB")
     db.row_factory = sqlite3.Row
-    cur = db.cursor()
-    cur.execute("SELECT COUNT(*) FROM sqlite_master")
-    if not cur.fetchone()[0]:
-        print("[I] DB empty, creating schema")
-        create_schema()
+    migrate()
 
 def close():
     global db
     if db is None:
         return
+    # let sqlite refresh the statistics of the indexes the queries of this session could have profited from
+    db.execute("PRAGMA optimize")
     db.close()
     db = None
 
+
+@contextmanager
+def transaction():
+    """Groups all changes made inside the with-block into a single commit. If the block raises, all of them are rolled
+    back. Nested blocks are part of the outermost transaction"""
+    global transaction_depth
+    transaction_depth += 1
+    try:
+        yield db
+    except BaseException:
+        transaction_depth -= 1
+        if not transaction_depth:
+            db.rollback()
+        raise
+    transaction_depth -= 1
+    if not transaction_depth:
+        db.commit()
+
+
+def _commit():
+    """Commits the changes, unless they are part of a transaction() which commits them when it is done"""
+    if not transaction_depth:
+        db.commit()
+
+
+@contextmanager
+def set_aside_triggers(table):
+    """Drops the triggers on the table for the with-block and creates them again afterwards. All of it happens within
+    the current transaction (which is started if there is none), so nothing else ever sees the table without them. If
+    the block raises, rolling back the transaction brings them back"""
+    cur = db.cursor()
+    if not db.in_transaction:
+        # sqlite3 only starts a transaction on its own before changing rows, not before dropping a trigger
+        cur.execute("BEGIN")
+    cur.execute("SELECT name, sql FROM sqlite_master WHERE type = 'trigger' AND tbl_name = ?", (table, ))
+    dropped = cur.fetchall()
+    for name, _ in dropped:
+        cur.execute(f"DROP TRIGGER {name}")
+    yield
+    for _, sql in dropped:
+        cur.execute(sql)
+
+
+def backup(file_name):
+    """Writes a consistent copy of the db to file_name using SQLite's online backup, which doesn't block writers"""
+    target = sqlite3.connect(file_name)
+    try:
+        db.backup(target)
+    finally:
+        target.close()
+
+
+def get_schema_version():
+    version = db.execute("PRAGMA user_version").fetchone()[0]
+    if version == 0 and db.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()[0]:
+        # databases created before the schema was versioned
+        has_counts = db.execute("SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name = 'deck_counts'")
+        version = 2 if has_counts.fetchone()[0] else 1
+    return version
+
+
+def migrate():
+    """Runs all migrations the db is missing. Every migration runs in its own transaction together with the update of
+    the schema version, so an interrupted upgrade is simply continued on the next start"""
+    version = get_schema_version()
+    if version > len(migrations):
+        logger.warning("DB schema version %s is newer than this version of the app (%s)", version, len(migrations))
+        return
+    for migration in migrations[version:]:
+        version += 1
+        logger.info("Migrating DB to schema version %s", version)
+        db.execute("BEGIN")
+        try:
+            migration()
+            db.execute(f"PRAGMA user_version = {version}")
+            db.commit()
+        except sqlite3.Error:
+            db.rollback()
+            raise
+
+
 def create_schema():
     """Creates the db with all necessary tables"""
-    connect_DB()
     cur = db.cursor()
     cur.execute("""CREATE TABLE decks (
         name TEXT NOT NULL PRIMARY KEY,
@@ -56,111 +213,925 @@ def create_schema():
         deck TEXT NOT NULL,
         FOREIGN KEY (deck) REFERENCES decks(name) ON DELETE CASCADE ON UPDATE CASCADE
     )""")
-    db.commit()
-    print("[D] Schema created")
+    logger.debug("Schema created")
+
+
+def create_deck_counts():
+    """Creates the table holding the number of due and total cards of every deck and the triggers keeping it current.
+    Only the deck's own cards are counted, the counts of the child decks are added up when reading them."""
+    cur = db.cursor()
+    cur.execute("""CREATE TABLE meta (
+        key TEXT NOT NULL PRIMARY KEY,
+        value
+    )""")
+    # the date the due counts were calculated for. Cards becoming due after that are added by roll_over_deck_counts
+    cur.execute("INSERT INTO meta VALUES ('counts_date', CURRENT_DATE)")
+    cur.execute("""CREATE TABLE deck_counts (
+        deck TEXT NOT NULL PRIMARY KEY,
+        due INTEGER NOT NULL DEFAULT 0,
+        total INTEGER NOT NULL DEFAULT 0,
+        FOREIGN KEY (deck) REFERENCES decks(name) ON DELETE CASCADE ON UPDATE CASCADE
+    )""")
+    cur.execute("""
+        INSERT INTO deck_counts
+        SELECT d.name, COALESCE(SUM(c.next_due_date <= CURRENT_DATE), 0), COUNT(c.title)
+        FROM decks AS d
+        LEFT JOIN cards AS c ON c.deck = d.name
+        GROUP BY d.name
+    """)
+    cur.execute("""CREATE TRIGGER deck_counts_deck_insert AFTER INSERT ON decks BEGIN
+        INSERT INTO deck_counts (deck) VALUES (new.name);
+    END""")
+    cur.execute("""CREATE TRIGGER deck_counts_card_insert AFTER INSERT ON cards BEGIN
+        UPDATE deck_counts
+        SET total = total + 1,
+            due = due + (new.next_due_date <= (SELECT value FROM meta WHERE key = 'counts_date'))
+        WHERE deck = new.deck;
+    END""")
+    cur.execute("""CREATE TRIGGER deck_counts_card_delete AFTER DELETE ON cards BEGIN
+        UPDATE deck_counts
+        SET total = total - 1,
+            due = due - (old.next_due_date <= (SELECT value FROM meta WHERE key = 'counts_date'))
+        WHERE deck = old.deck;
+    END""")
+    # Renaming a deck cascades to its cards. Their counts are moved along with the deck_counts row, so those updates
+    # are skipped (the old deck name does not exist anymore at that point)
+    cur.execute("""CREATE TRIGGER deck_counts_card_update AFTER UPDATE OF deck, next_due_date ON cards
+    WHEN old.deck = new.deck OR EXISTS (SELECT 1 FROM decks WHERE name = old.deck) BEGIN
+        UPDATE deck_counts
+        SET total = total - 1,
+            due = due - (old.next_due_date <= (SELECT value FROM meta WHERE key = 'counts_date'))
+        WHERE deck = old.deck;
+        UPDATE deck_counts
+        SET total = total + 1,
+            due = due + (new.next_due_date <= (SELECT value FROM meta WHERE key = 'counts_date'))
+        WHERE deck = new.deck;
+    END""")
+    logger.debug("Deck counts created")
+
+
+def create_indexes():
+    """Creates the indexes for the columns used to look up due cards, the cards of a deck and the child decks"""
+    cur = db.cursor()
+    # covers the due cards of a deck as well as the cascades when renaming or deleting a deck
+    cur.execute("CREATE INDEX cards_deck_next_due_date ON cards (deck, next_due_date)")
+    cur.execute("CREATE INDEX cards_next_due_date ON cards (next_due_date)")
+    cur.execute("CREATE INDEX decks_parent ON decks (parent)")
+    logger.debug("Indexes created")
+
+
+def create_card_list_index():
+    """Creates the index the card list of a deck is paged through"""
+    db.execute("CREATE INDEX cards_deck_title ON cards (deck, title)")
+    logger.debug("Card list index created")
+
+
+def create_review_log():
+    """Creates the table every review is appended to. Besides the grade, it holds the state of the card before and
+    after the review, so the algorithm's parameters can be fitted to it"""
+    cur = db.cursor()
+    cur.execute("""CREATE TABLE review_log (
+        id INTEGER PRIMARY KEY,
+        card TEXT NOT NULL,
+        reviewed_at DATE NOT NULL,
+        grade INTEGER NOT NULL,
+        delta_t INTEGER NOT NULL,
+        last_interval INTEGER,
+        last_difficulty FLOAT,
+        stability INTEGER NOT NULL,
+        difficulty FLOAT NOT NULL,
+        FOREIGN KEY (card) REFERENCES cards(title) ON DELETE CASCADE ON UPDATE CASCADE
+    )""")
+    cur.execute("CREATE INDEX review_log_card ON review_log (card, id)")
+    logger.debug("Review log created")
+
+
+def create_attachment_triggers(cur):
+    """Creates the triggers counting the cards using each attached file"""
+    cur.execute("""CREATE TRIGGER attachments_card_insert AFTER INSERT ON cards WHEN new.filename IS NOT NULL
+        BEGIN
+            INSERT INTO attachments VALUES (new.filename, 1)
+                ON CONFLICT (filename) DO UPDATE SET refcount = refcount + 1;
+        END""")
+    cur.execute("""CREATE TRIGGER attachments_card_delete AFTER DELETE ON cards WHEN old.filename IS NOT NULL
+        BEGIN
+            UPDATE attachments SET refcount = refcount - 1 WHERE filename = old.filename;
+        END""")
+    cur.execute("""CREATE TRIGGER attachments_card_update AFTER UPDATE OF filename ON cards
+        WHEN old.filename IS NOT new.filename
+        BEGIN
+            UPDATE attachments SET refcount = refcount - 1 WHERE filename = old.filename;
+            INSERT INTO attachments SELECT new.filename, 1 WHERE new.filename IS NOT NULL
+                ON CONFLICT (filename) DO UPDATE SET refcount = refcount + 1;
+        END""")
+
+
+def create_attachments():
+    """Creates the table counting how many cards use each attached file. The triggers keep the counts up to date, also
+    for the cards removed together with their deck"""
+    cur = db.cursor()
+    cur.execute("""CREATE TABLE attachments (
+        filename TEXT PRIMARY KEY,
+        refcount INTEGER NOT NULL
+    )""")
+    cur.execute("""
+        INSERT INTO attachments
+        SELECT filename, COUNT(*) FROM cards WHERE filename IS NOT NULL GROUP BY filename""")
+    create_attachment_triggers(cur)
+    logger.debug("Attachment reference counts created")
+
+
+def record(entity, key):
+    """The statements of a trigger recording a change of the entity with the key in the journal"""
+    # INSERT OR REPLACE would be shorter, but inside a foreign key's cascade the conflict clause is ignored
+    return f"""
+                DELETE FROM changes WHERE entity = '{entity}' AND key = {key};
+                INSERT INTO changes (entity, key) VALUES ('{entity}', {key});"""
+
+
+def record_rename(entity, old_key, new_key):
+    """The statement of a trigger recording a rename in the journal, right after the old key was recorded"""
+    return f"""INSERT INTO renames (seq, entity, old_key, new_key)
+                SELECT seq, '{entity}', {old_key}, {new_key} FROM changes WHERE entity = '{entity}' AND key = {old_key};"""
+
+
+def create_change_journal():
+    """Creates the journal of the changed cards, decks and attached files, recorded by triggers. Every changed row is
+    in there once, with the sequence number of its latest change, so a delta since a sequence number only has to look up
+    the current state of those rows (see get_changes)"""
+    cur = db.cursor()
+    cur.execute("""CREATE TABLE changes (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        entity TEXT NOT NULL,
+        key TEXT NOT NULL,
+        UNIQUE (entity, key)
+    )""")
+
+    for table, entity, key in [("cards", "card", "title"), ("decks", "deck", "name")]:
+        cur.execute(f"""CREATE TRIGGER changes_{entity}_insert AFTER INSERT ON {table}
+            BEGIN{record(entity, "new." + key)}
+            END""")
+        cur.execute(f"""CREATE TRIGGER changes_{entity}_delete AFTER DELETE ON {table}
+            BEGIN{record(entity, "old." + key)}
+            END""")
+        # a renamed row is deleted under its old key
+        cur.execute(f"""CREATE TRIGGER changes_{entity}_rename AFTER UPDATE OF {key} ON {table}
+            WHEN old.{key} != new.{key}
+            BEGIN{record(entity, "old." + key)}
+            END""")
+        cur.execute(f"""CREATE TRIGGER changes_{entity}_update AFTER UPDATE ON {table}
+            BEGIN{record(entity, "new." + key)}
+            END""")
+    cur.execute(f"""CREATE TRIGGER changes_attachment_insert AFTER INSERT ON attachments
+        BEGIN{record("attachment", "new.filename")}
+        END""")
+    logger.debug("Change journal created")
+
+
+def use_integer_ids():
+    """Replaces the names and titles as the primary keys of the decks and cards with integer ids, the names and titles
+    stay unique. Decks, cards and reviews reference each other by id, so renaming a deck or a card only changes its own
+    row. SQLite can't change a primary key, so the tables are built again next to the old ones, which are dropped
+    once everything was copied (the children first, so dropping them doesn't cascade to anything)"""
+    cur = db.cursor()
+    cur.execute("""CREATE TABLE decks_new (
+        id INTEGER PRIMARY KEY,
+        name TEXT NOT NULL UNIQUE,
+        parent_id INTEGER NULL,
+        FOREIGN KEY (parent_id) REFERENCES decks_new(id) ON DELETE CASCADE
+    )""")
+    # the rowids become the ids, which keeps the order the decks were created in
+    cur.execute("""INSERT INTO decks_new (id, name, parent_id)
+        SELECT d.rowid, d.name, p.rowid FROM decks AS d LEFT JOIN decks AS p ON p.name = d.parent""")
+    cur.execute("""CREATE TABLE cards_new (
+        id INTEGER PRIMARY KEY,
+        title TEXT NOT NULL UNIQUE,
+        filename TEXT,
+        created_at DATE,
+        next_due_date DATE,
+        last_difficulty FLOAT,
+        last_interval INTEGER,
+        deck_id INTEGER NOT NULL,
+        FOREIGN KEY (deck_id) REFERENCES decks_new(id) ON DELETE CASCADE
+    )""")
+    cur.execute("""INSERT INTO cards_new
+        SELECT c.rowid, c.title, c.filename, c.created_at, c.next_due_date, c.last_difficulty, c.last_interval, d.rowid
+        FROM cards AS c JOIN decks AS d ON d.name = c.deck
+        WHERE c.title IS NOT NULL""")
+    cur.execute("""CREATE TABLE review_log_new (
+        id INTEGER PRIMARY KEY,
+        card_id INTEGER NOT NULL,
+        reviewed_at DATE NOT NULL,
+        grade INTEGER NOT NULL,
+        delta_t INTEGER NOT NULL,
+        last_interval INTEGER,
+        last_difficulty FLOAT,
+        stability INTEGER NOT NULL,
+        difficulty FLOAT NOT NULL,
+        FOREIGN KEY (card_id) REFERENCES cards_new(id) ON DELETE CASCADE
+    )""")
+    cur.execute("""INSERT INTO review_log_new
+        SELECT r.id, c.rowid, r.reviewed_at, r.grade, r.delta_t, r.last_interval, r.last_difficulty, r.stability,
+               r.difficulty
+        FROM review_log AS r JOIN cards AS c ON c.title = r.card""")
+    cur.execute("""CREATE TABLE deck_counts_new (
+        deck_id INTEGER NOT NULL PRIMARY KEY,
+        due INTEGER NOT NULL DEFAULT 0,
+        total INTEGER NOT NULL DEFAULT 0,
+        FOREIGN KEY (deck_id) REFERENCES decks_new(id) ON DELETE CASCADE
+    )""")
+    cur.execute("""INSERT INTO deck_counts_new
+        SELECT d.rowid, k.due, k.total FROM deck_counts AS k JOIN decks AS d ON d.name = k.deck""")
+
+    # Dropping a table deletes its rows first, which cascades to the decks' child decks. The triggers (which would
+    # journal those deletions) are dropped beforehand, the indexes are dropped along with the tables
+    old_tables = ("review_log", "deck_counts", "cards", "decks")
+    triggers = cur.execute(f"""SELECT name FROM sqlite_master
+        WHERE type = 'trigger' AND tbl_name IN ({', '.join('?' * len(old_tables))})""", old_tables).fetchall()
+    for trigger, in triggers:
+        cur.execute(f"DROP TRIGGER {trigger}")
+    for table in old_tables:
+        cur.execute(f"DROP TABLE {table}")
+    # renaming a table also renames it in the foreign keys referencing it
+    for table in ("decks", "cards", "review_log", "deck_counts"):
+        cur.execute(f"ALTER TABLE {table}_new RENAME TO {table}")
+
+    cur.execute("CREATE INDEX cards_deck_next_due_date ON cards (deck_id, next_due_date)")
+    cur.execute("CREATE INDEX cards_next_due_date ON cards (next_due_date)")
+    cur.execute("CREATE INDEX cards_deck_title ON cards (deck_id, title)")
+    cur.execute("CREATE INDEX decks_parent ON decks (parent_id)")
+    cur.execute("CREATE INDEX review_log_card ON review_log (card_id, id)")
+
+    cur.execute("""CREATE TRIGGER deck_counts_deck_insert AFTER INSERT ON decks BEGIN
+        INSERT INTO deck_counts (deck_id) VALUES (new.id);
+    END""")
+    cur.execute("""CREATE TRIGGER deck_counts_card_insert AFTER INSERT ON cards BEGIN
+        UPDATE deck_counts
+        SET total = total + 1,
+            due = due + (new.next_due_date <= (SELECT value FROM meta WHERE key = 'counts_date'))
+        WHERE deck_id = new.deck_id;
+    END""")
+    cur.execute("""CREATE TRIGGER deck_counts_card_delete AFTER DELETE ON cards BEGIN
+        UPDATE deck_counts
+        SET total = total - 1,
+            due = due - (old.next_due_date <= (SELECT value FROM meta WHERE key = 'counts_date'))
+        WHERE deck_id = old.deck_id;
+    END""")
+    cur.execute("""CREATE TRIGGER deck_counts_card_update AFTER UPDATE OF deck_id, next_due_date ON cards BEGIN
+        UPDATE deck_counts
+        SET total = total - 1,
+            due = due - (old.next_due_date <= (SELECT value FROM meta WHERE key = 'counts_date'))
+        WHERE deck_id = old.deck_id;
+        UPDATE deck_counts
+        SET total = total + 1,
+            due = due + (new.next_due_date <= (SELECT value FROM meta WHERE key = 'counts_date'))
+        WHERE deck_id = new.deck_id;
+    END""")
+    create_attachment_triggers(cur)
+
+    # the journal still records the names and titles, the ids of the same deck or card differ between two dbs
+    for table, entity, key in [("cards", "card", "title"), ("decks", "deck", "name")]:
+        cur.execute(f"""CREATE TRIGGER changes_{entity}_insert AFTER INSERT ON {table}
+            BEGIN{record(entity, "new." + key)}
+            END""")
+        cur.execute(f"""CREATE TRIGGER changes_{entity}_delete AFTER DELETE ON {table}
+            BEGIN{record(entity, "old." + key)}
+            END""")
+        cur.execute(f"""CREATE TRIGGER changes_{entity}_update AFTER UPDATE ON {table}
+            BEGIN{record(entity, "new." + key)}
+            END""")
+    # A renamed card is deleted under its old title. A renamed deck is deleted under its old name as well, and as
+    # a delta refers to the decks by name, its cards and child decks changed along with it
+    cur.execute(f"""CREATE TRIGGER changes_card_rename AFTER UPDATE OF title ON cards
+        WHEN old.title != new.title
+        BEGIN{record("card", "old.title")}
+        END""")
+    cur.execute(f"""CREATE TRIGGER changes_deck_rename AFTER UPDATE OF name ON decks
+        WHEN old.name != new.name
+        BEGIN{record("deck", "old.name")}
+            DELETE FROM changes WHERE entity = 'card' AND key IN (SELECT title FROM cards WHERE deck_id = new.id);
+            INSERT INTO changes (entity, key) SELECT 'card', title FROM cards WHERE deck_id = new.id;
+            DELETE FROM changes WHERE entity = 'deck' AND key IN (SELECT name FROM decks WHERE parent_id = new.id);
+            INSERT INTO changes (entity, key) SELECT 'deck', name FROM decks WHERE parent_id = new.id;
+        END""")
+    logger.debug("Integer ids introduced")
+
+
+def create_deck_closure():
+    """Creates the table holding every (ancestor, descendant) pair of decks, including every deck with itself, and the
+    triggers keeping it current. The subtree of a deck is a single lookup in it instead of a walk down the tree, and a
+    deck can't be moved into its own subtree anymore."""
+    cur = db.cursor()
+    # Moving a deck into one of its child decks used to be possible. Those decks are cut off from the top-level decks,
+    # the deck with the lowest id of every such cycle is made a top-level deck again
+    while True:
+        cur.execute("""
+            WITH RECURSIVE reachable(id) AS (
+                SELECT id FROM decks WHERE parent_id IS NULL
+                UNION
+                SELECT d.id
+                FROM decks d
+                JOIN reachable r ON r.id = d.parent_id
+            )
+            SELECT MIN(id) FROM decks WHERE id NOT IN reachable""")
+        deck = cur.fetchone()[0]
+        if deck is None:
+            break
+        logger.warning("Deck %s is part of a cycle, it's moved to the top level", deck)
+        cur.execute("UPDATE decks SET parent_id = NULL WHERE id = ?", (deck, ))
+
+    cur.execute("""CREATE TABLE deck_closure (
+        ancestor INTEGER NOT NULL,
+        descendant INTEGER NOT NULL,
+        PRIMARY KEY (ancestor, descendant),
+        FOREIGN KEY (ancestor) REFERENCES decks(id) ON DELETE CASCADE,
+        FOREIGN KEY (descendant) REFERENCES decks(id) ON DELETE CASCADE
+    ) WITHOUT ROWID""")
+    # used by the cascades when a deck is deleted and to find the ancestors of a deck
+    cur.execute("CREATE INDEX deck_closure_descendant ON deck_closure (descendant, ancestor)")
+    cur.execute("""
+        WITH RECURSIVE closure(ancestor, descendant) AS (
+            SELECT id, id FROM decks
+            UNION ALL
+            SELECT c.ancestor, d.id
+            FROM decks d
+            JOIN closure c ON c.descendant = d.parent_id
+        )
+        INSERT INTO deck_closure (ancestor, descendant) SELECT ancestor, descendant FROM closure""")
+
+    cur.execute("""CREATE TRIGGER deck_closure_insert AFTER INSERT ON decks BEGIN
+        INSERT INTO deck_closure (ancestor, descendant)
+        SELECT ancestor, new.id FROM deck_closure WHERE descendant = new.parent_id
+        UNION ALL
+        SELECT new.id, new.id;
+    END""")
+    # runs before the update is written, so a move into the deck's own subtree never gets into the table
+    cur.execute("""CREATE TRIGGER deck_closure_cycle BEFORE UPDATE OF parent_id ON decks
+        WHEN new.parent_id IN (SELECT descendant FROM deck_closure WHERE ancestor = new.id)
+        BEGIN
+            SELECT RAISE(ABORT, 'a deck can not be moved into its own subtree');
+        END""")
+    # the subtree of the moved deck loses its old ancestors above the deck and gets the new ones, all at once
+    cur.execute("""CREATE TRIGGER deck_closure_move AFTER UPDATE OF parent_id ON decks
+        WHEN old.parent_id IS NOT new.parent_id
+        BEGIN
+            DELETE FROM deck_closure
+            WHERE descendant IN (SELECT descendant FROM deck_closure WHERE ancestor = new.id)
+              AND ancestor NOT IN (SELECT descendant FROM deck_closure WHERE ancestor = new.id);
+            INSERT INTO deck_closure (ancestor, descendant)
+            SELECT a.ancestor, s.descendant
+            FROM deck_closure AS a
+            JOIN deck_closure AS s ON s.ancestor = new.id
+            WHERE a.descendant = new.parent_id;
+        END""")
+    logger.debug("Deck closure created")
+
+
+def sql_day_number(expression):
+    """SQL converting a 'YYYY-MM-DD' string to a day number"""
+    return f"CAST(julianday({expression}) - {EPOCH_JULIAN_DAY} AS INTEGER)"
+
+
+def sql_date(expression):
+    """SQL converting a day number to a 'YYYY-MM-DD' string"""
+    return f"date({expression} + {EPOCH_JULIAN_DAY})"
+
+
+def use_day_numbers():
+    """Stores the dates of the cards and the review log as day numbers instead of 'YYYY-MM-DD' strings, and adds the
+    date of its last review to every card. The columns keep their declared type, SQLite stores the numbers as integers
+    either way"""
+    cur = db.cursor()
+    # the triggers on the cards would count and journal every converted card again
+    with set_aside_triggers("cards"):
+        cur.execute("ALTER TABLE cards ADD COLUMN last_review INTEGER")
+        cur.execute(f"""UPDATE cards SET
+            created_at = {sql_day_number("created_at")},
+            next_due_date = {sql_day_number("next_due_date")}""")
+        # the scheduled interval of a card that was studied starts at its last review
+        cur.execute("UPDATE cards SET last_review = next_due_date - last_interval WHERE last_difficulty IS NOT NULL")
+    cur.execute(f"UPDATE review_log SET reviewed_at = {sql_day_number('reviewed_at')}")
+    cur.execute(f"UPDATE meta SET value = {sql_day_number('value')} WHERE key = 'counts_date'")
+    logger.debug("Dates converted to day numbers")
+
+
+def journal_renames():
+    """Journals renamed decks and cards as (old key, new key) pairs, so a delta renames them in place. Before, a rename
+    only showed up as the old key being deleted and the new one being changed, which made another db delete the deck or
+    card (and the reviews of its cards) and add it again"""
+    cur = db.cursor()
+    # a key can be renamed several times, by different rows even, so the renames are kept in the order they happened.
+    # Every rename gets the sequence number its old key was journaled with
+    cur.execute("""CREATE TABLE renames (
+        seq INTEGER PRIMARY KEY,
+        entity TEXT NOT NULL,
+        old_key TEXT NOT NULL,
+        new_key TEXT NOT NULL
+    )""")
+    cur.execute("DROP TRIGGER changes_card_rename")
+    cur.execute("DROP TRIGGER changes_deck_rename")
+    # The old key is still journaled, it's deleted in case the new key is taken in the other db. The cards and child
+    # decks of a renamed deck aren't, the other db renames the deck in place and they follow it (see apply_changes)
+    cur.execute(f"""CREATE TRIGGER changes_card_rename AFTER UPDATE OF title ON cards
+        WHEN old.title != new.title
+        BEGIN{record("card", "old.title")}
+            {record_rename("card", "old.title", "new.title")}
+        END""")
+    cur.execute(f"""CREATE TRIGGER changes_deck_rename AFTER UPDATE OF name ON decks
+        WHEN old.name != new.name
+        BEGIN{record("deck", "old.name")}
+            {record_rename("deck", "old.name", "new.name")}
+        END""")
+    logger.debug("Renames journaled")
+
+
+# The migrations bringing the schema from one version to the next, the schema version is the position in this list
+migrations = [
+    create_schema,
+    create_deck_counts,
+    create_indexes,
+    create_card_list_index,
+    create_review_log,
+    create_attachments,
+    create_change_journal,
+    use_integer_ids,
+    create_deck_closure,
+    use_day_numbers,
+    journal_renames,
+]
+
+
+def roll_over_deck_counts():
+    """Adds the cards that became due since the deck counts were last calculated. This only touches the cards due in
+    between, so it's cheap to call whenever the counts are read."""
+    cur = db.cursor()
+    cur.execute("SELECT value FROM meta WHERE key = 'counts_date'")
+    counts_date = cur.fetchone()[0]
+    day = today()
+    if counts_date == day:
+        return
+    if counts_date < day:
+        cur.execute("""SELECT deck_id, COUNT(*) FROM cards
+            WHERE next_due_date > ? AND next_due_date <= ?
+            GROUP BY deck_id""", (counts_date, day))
+        cur.executemany("UPDATE deck_counts SET due = due + ? WHERE deck_id = ?",
+                        [(count, deck) for deck, count in cur.fetchall()])
+    else:
+        # the clock went backwards, count everything again
+        cur.execute("""UPDATE deck_counts SET due = (
+            SELECT COUNT(*) FROM cards WHERE deck_id = deck_counts.deck_id AND next_due_date <= ?
+        )""", (day, ))
+    cur.execute("UPDATE meta SET value = ? WHERE key = 'counts_date'", (day, ))
+    _commit()
+    logger.debug("Deck counts rolled over from %s to %s", counts_date, day)
+
 
 def drop_tables():
     cur = db.cursor()
-    cur.execute("DROP TABLE decks")
+    # the tables the triggers write to go last, deleting child decks in the cascade of dropping the decks fires them
+    cur.execute("DROP TABLE review_log")
+    cur.execute("DROP TABLE deck_counts")
+    cur.execute("DROP TABLE deck_closure")
     cur.execute("DROP TABLE cards")
-    db.commit()
-    print("[D] All tables were dropped")
+    cur.execute("DROP TABLE decks")
+    cur.execute("DROP TABLE changes")
+    cur.execute("DROP TABLE renames")
+    cur.execute("DROP TABLE attachments")
+    cur.execute("DROP TABLE meta")
+    cur.execute("PRAGMA user_version = 0")
+    _commit()
+    logger.debug("All tables were dropped")
+
+
+# the day a card was last studied, a card that was never studied counts from its due date (see studyqueue.review_state)
+last_review_column = "COALESCE(last_review, next_due_date - COALESCE(last_interval, 0))"
+
+# the ids of a deck (the parameter) and all of its child decks
+deck_tree_query = """
+    WITH deck_tree(id) AS (
+        SELECT descendant FROM deck_closure WHERE ancestor = ?
+    )
+"""
+
 
 def add_deck(name, parent=None):
+    """Adds a deck, as a child deck of the deck with the id parent if given. Returns its id, or None if there's a deck
+    with that name already"""
     try:
-        db.cursor().execute("INSERT INTO decks values (?, ?)", (name, parent))
-        db.commit()
-        return True
+        cur = db.execute("INSERT INTO decks (name, parent_id) VALUES (?, ?)", (name, parent))
+        _commit()
+        return cur.lastrowid
     except sqlite3.IntegrityError as e:
-        print(f"Caught an Exception while trying to add deck: {e}")
-        return False
+        logger.warning("Caught an Exception while trying to add deck: %s", e)
+        return None
+
 
+def add_decks(decks):
+    """Adds the (name, parent name) decks that don't exist yet. Parents have to come before their child decks"""
+    db.executemany("""INSERT INTO decks (name, parent_id) SELECT ?, (SELECT id FROM decks WHERE name = ?) WHERE true
+        ON CONFLICT (name) DO NOTHING""", decks)
+    _commit()
 
-def change_deck_parent(name, parent=None):
-    db.cursor().execute("UPDATE decks set parent=? where name=?", (parent, name))
-    db.commit()
 
+def get_deck_parents():
+    """Returns the name of the parent deck of every deck (None for a top-level deck), by deck name"""
+    cur = db.execute("SELECT d.name, p.name FROM decks AS d LEFT JOIN decks AS p ON p.id = d.parent_id")
+    return dict(cur.fetchall())
 
-def rename_deck(old_name, new_name):
+
+def get_deck_id(name):
+    """Returns the id of the deck with the name, or None if there is none"""
+    row = db.execute("SELECT id FROM decks WHERE name = ?", (name, )).fetchone()
+    return row[0] if row else None
+
+
+def change_deck_parent(deck, parent=None):
+    """Moves the deck (with its child decks) under the deck with the id parent, or to the top level. Returns False if
+    parent is the deck itself or one of its child decks"""
     try:
-        db.execute("UPDATE decks set name=? where name=?", (new_name, old_name))
-        db.commit()
+        db.cursor().execute("UPDATE decks set parent_id=? where id=?", (parent, deck))
+        _commit()
         return True
     except sqlite3.IntegrityError as e:
-        print(f"Caught an Exception while trying to rename deck: {e}")
+        logger.warning("Caught an Exception while trying to move deck: %s", e)
         return False
-def add_card(deck, title, file=None):
+
+
+def rename_deck(deck, new_name):
     try:
-        db.cursor().execute("INSERT INTO cards values (?, ?, CURRENT_DATE, CURRENT_DATE, null, null, ?)", (title, file, deck))
-        db.commit()
+        db.execute("UPDATE decks set name=? where id=?", (new_name, deck))
+        _commit()
         return True
     except sqlite3.IntegrityError as e:
-        print(f"Caught an Exception while trying to add card: {e}")
+        logger.warning("Caught an Exception while trying to rename deck: %s", e)
         return False
 
 
-def get_card(title):
+def add_card(deck, title, file=None):
+    """Adds a card to the deck with the id deck. Returns its id, or None if there's a card with that title already"""
+    try:
+        cur = db.execute("""INSERT INTO cards (title, filename, created_at, next_due_date, deck_id)
+            VALUES (?, ?, ?, ?, ?)""", (title, file, today(), today(), deck))
+        _commit()
+        return cur.lastrowid
+    except sqlite3.IntegrityError as e:
+        logger.warning("Caught an Exception while trying to add card: %s", e)
+        return None
+
+
+def add_cards(cards):
+    """Adds the (deck name, title, file) cards at once"""
+    day = today()
+    db.executemany("""INSERT INTO cards (title, filename, created_at, next_due_date, deck_id)
+        SELECT ?, ?, ?, ?, id FROM decks WHERE name = ?""",
+                   [(title, file, day, day, deck) for deck, title, file in cards])
+    _commit()
+
+
+def get_existing_titles(titles):
+    """Returns the titles out of the given ones that are used by a card already"""
+    titles = list(titles)
+    existing = set()
+    # stay below SQLite's limit of variables per statement
+    for start in range(0, len(titles), 500):
+        chunk = titles[start:start + 500]
+        cur = db.execute(f"SELECT title FROM cards WHERE title IN ({', '.join('?' * len(chunk))})", chunk)
+        existing.update(row[0] for row in cur.fetchall())
+    return existing
+
+
+def get_card(card):
+    """Returns the card with the id as a Card, or None if there is none"""
     cur = db.cursor()
-    cur.execute("""SELECT * from cards where title=?""", (title, ))
-    return cur.fetchall()[0]
+    cur.row_factory = card_factory
+    cur.execute(f"""SELECT {card_columns} from cards where id=?""", (card, ))
+    return cur.fetchone()
 
 
-def get_cards(deck, include_children_cards=True, only_due=False):
-    """Returns the cards of the deck and all of its child decks"""
+def get_card_files(cards):
+    """Returns the attached files of the cards (by id) in the order of the cards, leaving out cards without a file"""
+    cards = list(cards)
+    files = dict(db.execute(f"SELECT id, filename FROM cards WHERE id IN ({', '.join('?' * len(cards))}) "
+                            f"AND filename IS NOT NULL", cards).fetchall())
+    return [files[card] for card in cards if card in files]
+
+
+def get_card_titles(deck, after=None, limit=200):
+    """Returns (id, title) of up to limit cards of the deck (without its child decks) in alphabetical order, starting
+    after the given title. Used to page through the cards of a deck"""
     cur = db.cursor()
-    if deck is None:
-        if only_due:
-            cur.execute("SELECT * FROM cards WHERE next_due_date <= CURRENT_DATE")
-        else:
-            cur.execute("SELECT * FROM cards")
+    cur.row_factory = None
+    if after is None:
+        cur.execute("SELECT id, title FROM cards WHERE deck_id = ? ORDER BY title LIMIT ?", (deck, limit))
     else:
+        cur.execute("SELECT id, title FROM cards WHERE deck_id = ? AND title > ? ORDER BY title LIMIT ?",
+                    (deck, after, limit))
+    return cur.fetchall()
+
+
+def iter_due_cards(deck, page_size=500):
+    """Yields (id, last review, last_interval, is new) of the due cards of the deck and its child decks. The rows are
+    fetched page by page, so they never have to be in memory all at once"""
+    cur = db.cursor()
+    cur.row_factory = None
+    cur.execute(deck_tree_query + f"""
+        SELECT id, {last_review_column}, last_interval, last_difficulty IS NULL
+        FROM cards
+        WHERE deck_id IN deck_tree AND next_due_date <= ?""", (deck, today()))
+    while rows := cur.fetchmany(page_size):
+        yield from rows
+
+
+def get_cards(deck, include_children_cards=True, only_due=False):
+    """Returns the cards of the deck (by id) and all of its child decks, or of all decks if deck is None, as Cards"""
+    conditions = []
+    parameters = []
+    query = f"SELECT {card_columns} FROM cards"
+    if deck is not None:
         if include_children_cards:
-            query = """
-               WITH RECURSIVE deck_tree(name, parent) AS (
-                  SELECT name, parent FROM decks WHERE name = ?              
-                  UNION ALL
-                  -- Recursive step: add child decks to the result set
-                  SELECT d.name, d.parent
-                  FROM decks d
-                  JOIN deck_tree dt ON dt.name = d.parent
-                ) 
-                
-                SELECT c.*
-                FROM cards AS c
-                JOIN deck_tree AS dt ON c.deck = dt.name
-            """
+            query = deck_tree_query + query
+            conditions.append("deck_id IN deck_tree")
         else:
-            query = "SELECT * from cards where deck = ?"
+            conditions.append("deck_id = ?")
+        parameters.append(deck)
+    if only_due:
+        conditions.append("next_due_date <= ?")
+        parameters.append(today())
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    cur = db.cursor()
+    cur.row_factory = card_factory
+    return cur.execute(query, parameters).fetchall()
+
 
-        if only_due:
-            query += "WHERE next_due_date <= CURRENT_DATE\n"
-        cur.execute(query, (deck, ))
+def update_card_after_review(card, difficulty, stability, next_due_date, grade, delta_t):
+    """Stores the result of a review today and appends it to the review log. next_due_date is a date"""
+    day = today()
+    with transaction():
+        cur = db.cursor()
+        # log the card's state before it's overwritten
+        cur.execute("""INSERT INTO review_log
+            (card_id, reviewed_at, grade, delta_t, last_interval, last_difficulty, stability, difficulty)
+            SELECT id, ?, ?, ?, last_interval, last_difficulty, ?, ? FROM cards WHERE id=?""",
+                    (day, grade, delta_t, stability, difficulty, card))
+        cur.execute("""UPDATE cards set last_difficulty = ?, last_interval = ?, next_due_date = ?, last_review = ?
+            WHERE id=?""", (difficulty, stability, day_number(next_due_date), day, card))
+
+
+def log_reviews(reviews):
+    """Appends many reviews to the review log at once, e.g. when importing the history of cards. Every review is a
+    tuple of (card id, reviewed_at (a day number), grade, delta_t, last_interval, last_difficulty, stability,
+    difficulty)"""
+    with transaction():
+        db.executemany("""INSERT INTO review_log
+            (card_id, reviewed_at, grade, delta_t, last_interval, last_difficulty, stability, difficulty)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)""", reviews)
+
+
+def get_review_log(deck=None):
+    """Returns all reviews (or those of the cards of the deck and its child decks) as (card id, grade, delta_t,
+    last_interval, last_difficulty) tuples, ordered by card and then in the order they happened"""
+    cur = db.cursor()
+    # plain tuples, there can be millions of reviews
+    cur.row_factory = None
+    if deck is None:
+        cur.execute("SELECT card_id, grade, delta_t, last_interval, last_difficulty FROM review_log ORDER BY card_id, id")
+    else:
+        cur.execute(deck_tree_query + """
+            SELECT card_id, grade, delta_t, last_interval, last_difficulty FROM review_log
+            WHERE card_id IN (SELECT id FROM cards WHERE deck_id IN deck_tree)
+            ORDER BY card_id, id""", (deck, ))
     return cur.fetchall()
 
 
-def update_card_after_review(title, difficulty, stability, next_due_date):
-    if next_due_date is date:
-        next_due_date = next_due_date.strftime('%Y-%m-%d')
+def get_last_review_dates():
+    """Returns the day number of the latest review of every card that was reviewed, by card id"""
+    return dict(db.execute("SELECT card_id, MAX(reviewed_at) FROM review_log GROUP BY card_id").fetchall())
+
+
+def set_schedules(schedules):
+    """Overwrites the schedule of many cards at once, every schedule is a tuple of (card id, next_due_date (a day
+    number), last_interval, last_difficulty). The interval is taken to start at the card's last review"""
+    with transaction():
+        db.executemany("""UPDATE cards SET next_due_date = ?, last_interval = ?, last_difficulty = ?, last_review = ?
+            WHERE id = ?""", [(next_due_date, stability, difficulty, next_due_date - stability, card)
+                              for card, next_due_date, stability, difficulty in schedules])
+
+
+def spread_due_cards(deck, days):
+    """Spreads the due cards of the deck and its child decks evenly over the given number of days, starting today.
+    The cards are ranked the way studyqueue.retrievability orders them, the least retrievable ones stay due the soonest.
+    Every card keeps the day it was last studied, so moving it doesn't change what a review will do. Returns the number
+    of cards"""
+    # the deck counts know how many cards are due (and are rolled over to today), counting them here would be slower
+    count = get_due_count(deck)
+    if not count:
+        return 0
+    parameters = {"deck": deck, "today": today(), "days": days, "count": count}
+    # the day a card is moved to, by its rank
+    due = "(:today + (s.rank - 1) * :days / :count)"
+    with transaction():
+        cur = db.cursor()
+        # Retrievability falls with (days since the last review / last interval), so the cards are ranked by that
+        # instead. A new card is as urgent as a card that's due today (1), a card without an interval isn't retrievable
+        # at all. The rank is the rowid, the cards get it in the order they're inserted
+        cur.execute("""CREATE TEMP TABLE IF NOT EXISTS spread (
+            rank INTEGER PRIMARY KEY, card_id INTEGER, title TEXT, deck_id INTEGER, due_date INTEGER)""")
+        cur.execute("DELETE FROM temp.spread")
+        cur.execute(f"""INSERT INTO temp.spread (card_id, title, deck_id, due_date)
+            SELECT id, title, deck_id, next_due_date FROM cards
+            WHERE deck_id IN (SELECT descendant FROM deck_closure WHERE ancestor = :deck) AND next_due_date <= :today
+            ORDER BY CASE WHEN last_difficulty IS NULL THEN 1.0
+                          WHEN COALESCE(last_interval, 0) = 0 THEN 9e999
+                          ELSE (:today - {last_review_column}) * 1.0 / last_interval
+                     END DESC, id""", parameters)
+        # cards that are due today and stay due today aren't touched
+        cur.execute(f"DELETE FROM temp.spread AS s WHERE {due} = :today AND due_date = :today", parameters)
+        # what the triggers on the cards would do card by card, done for all of the cards at once. Card by card, it
+        # takes the better part of the time
+        cur.execute(f"""UPDATE deck_counts SET due = deck_counts.due + moved.change
+            FROM (
+                SELECT deck_id, SUM(({due} <= counts_date.value) - (due_date <= counts_date.value)) AS change
+                FROM temp.spread AS s
+                JOIN meta AS counts_date ON counts_date.key = 'counts_date'
+                GROUP BY deck_id
+            ) AS moved
+            WHERE deck_counts.deck_id = moved.deck_id""", parameters)
+        cur.execute("DELETE FROM changes WHERE entity = 'card' AND key IN (SELECT title FROM temp.spread)")
+        cur.execute("INSERT INTO changes (entity, key) SELECT 'card', title FROM temp.spread")
+        with set_aside_triggers("cards"):
+            cur.execute(f"""UPDATE cards SET next_due_date = {due}, last_review = {last_review_column}
+                FROM temp.spread AS s
+                WHERE cards.id = s.card_id""", parameters)
+        cur.execute("DELETE FROM temp.spread")
+    return count
+
+
+def get_grade_counts():
+    """Returns how often each grade (1 to 4) was given so far"""
+    counts = dict(db.execute("SELECT grade, COUNT(*) FROM review_log GROUP BY grade").fetchall())
+    return [counts.get(grade, 0) for grade in range(1, 5)]
+
+
+def get_card_states(deck=None):
+    """Returns (days until due, days since the last review, last_interval, last_difficulty) of all cards of the deck and
+    its child decks (or of all cards). Overdue cards have a negative number of days until due"""
+    cur = db.cursor()
+    cur.row_factory = None
+    query = f"SELECT next_due_date - ?, ? - {last_review_column}, last_interval, last_difficulty FROM cards"
+    day = today()
+    if deck is None:
+        cur.execute(query, (day, day))
+    else:
+        cur.execute(deck_tree_query + query + " WHERE deck_id IN deck_tree", (deck, day, day))
+    return cur.fetchall()
+
+
+def get_parameters():
+    """Returns the fitted parameters of the algorithm or None if they were never fitted"""
+    row = db.execute("SELECT value FROM meta WHERE key = 'parameters'").fetchone()
+    return tuple(json.loads(row[0])) if row else None
+
+
+def set_parameters(parameters):
+    db.execute("INSERT OR REPLACE INTO meta VALUES ('parameters', ?)", (json.dumps(list(parameters)), ))
+    _commit()
+
+
+def get_change_seq():
+    """Returns the sequence number of the latest change"""
+    return db.execute("SELECT COALESCE(MAX(seq), 0) FROM changes").fetchone()[0]
+
+
+def get_exported_seq():
+    """Returns the sequence number of the latest change that was exported"""
+    row = db.execute("SELECT value FROM meta WHERE key = 'exported_seq'").fetchone()
+    return int(row[0]) if row else 0
+
+
+def set_exported_seq(seq):
+    db.execute("INSERT OR REPLACE INTO meta VALUES ('exported_seq', ?)", (seq, ))
+    _commit()
+
+
+def get_changes(since):
+    """Returns the current state of all decks and cards that changed after the sequence number since, the (old key, new
+    key) of the ones that were renamed, the keys of the ones that were deleted and the attached files they need. Decks
+    and cards refer to each other by name and title, the ids of the same deck or card differ between two dbs"""
     cur = db.cursor()
-    cur.execute("UPDATE cards set last_difficulty = ?, last_interval = ?, next_due_date = ? WHERE title=?", (difficulty, stability, next_due_date, title))
-    db.commit()
+    cur.execute("""
+        SELECT d.name, p.name AS parent FROM changes AS c
+        JOIN decks AS d ON d.name = c.key
+        LEFT JOIN decks AS p ON p.id = d.parent_id
+        WHERE c.entity = 'deck' AND c.seq > ?""", (since, ))
+    decks = [dict(row) for row in cur.fetchall()]
+    # the dates are exported as 'YYYY-MM-DD' strings, as they were before they were stored as day numbers
+    cur.execute(f"""
+        SELECT k.title, k.filename, {sql_date("k.created_at")} AS created_at,
+               {sql_date("k.next_due_date")} AS next_due_date, {sql_date("k.last_review")} AS last_review,
+               k.last_difficulty, k.last_interval, d.name AS deck
+        FROM changes AS c
+        JOIN cards AS k ON k.title = c.key
+        JOIN decks AS d ON d.id = k.deck_id
+        WHERE c.entity = 'card' AND c.seq > ?""", (since, ))
+    cards = [dict(row) for row in cur.fetchall()]
+    renamed = dict()
+    for entity in ("deck", "card"):
+        cur.execute("SELECT old_key, new_key FROM renames WHERE entity = ? AND seq > ? ORDER BY seq", (entity, since))
+        renamed[entity] = [list(row) for row in cur.fetchall()]
+    deleted = dict()
+    for entity, table, key in [("deck", "decks", "name"), ("card", "cards", "title")]:
+        cur.execute(f"""
+            SELECT c.key FROM changes AS c
+            WHERE c.entity = ? AND c.seq > ? AND NOT EXISTS (SELECT 1 FROM {table} WHERE {key} = c.key)""",
+                    (entity, since))
+        deleted[entity] = [row[0] for row in cur.fetchall()]
+    cur.execute("""
+        SELECT a.filename FROM changes AS c JOIN attachments AS a ON a.filename = c.key
+        WHERE c.entity = 'attachment' AND c.seq > ? AND a.refcount > 0""", (since, ))
+    file_names = {row[0] for row in cur.fetchall()} | {card["filename"] for card in cards if card["filename"]}
+    return {
+        "decks": decks,
+        "cards": cards,
+        "renamed_decks": renamed["deck"],
+        "renamed_cards": renamed["card"],
+        "deleted_decks": deleted["deck"],
+        "deleted_cards": deleted["card"],
+        "attachments": sorted(file_names),
+    }
+
 
+def apply_changes(changes):
+    """Merges the changes returned by get_changes (on another db) into this db, all at once or not at all. The decks
+    are created before their cards are added, and only removed once their cards could be moved elsewhere"""
+    with transaction():
+        cur = db.cursor()
+        # Renamed decks and cards keep their rows (and reviews), in the order they were renamed in. The cards and child
+        # decks of a renamed deck aren't in the changes, they follow the deck. If its new name is taken by another deck
+        # here, they're moved to that one and the old deck is deleted. If the new title of a card is taken, the old
+        # card stays and is deleted with the other deleted keys
+        for old, new in changes.get("renamed_decks", []):
+            if cur.execute("UPDATE OR IGNORE decks SET name = ? WHERE name = ?", (new, old)).rowcount:
+                continue
+            row = cur.execute("""SELECT o.id, o.parent_id, n.id FROM decks AS o JOIN decks AS n ON n.name = ?
+                WHERE o.name = ?""", (new, old)).fetchone()
+            if row is None:
+                continue
+            old_deck, parent, deck = row
+            # a deck can't be moved into its own subtree, if the other deck is below the old one it takes its place
+            cur.execute("""UPDATE decks SET parent_id = ? WHERE id = ?
+                AND id IN (SELECT descendant FROM deck_closure WHERE ancestor = ?)""", (parent, deck, old_deck))
+            cur.execute("UPDATE cards SET deck_id = ? WHERE deck_id = ?", (deck, old_deck))
+            cur.execute("UPDATE decks SET parent_id = ? WHERE parent_id = ?", (deck, old_deck))
+            cur.execute("DELETE FROM decks WHERE id = ?", (old_deck, ))
+        cur.executemany("UPDATE OR IGNORE cards SET title = ? WHERE title = ?",
+                        [(new, old) for old, new in changes.get("renamed_cards", [])])
+        # the parents are only set once all decks exist. The changed decks are taken out of the tree first, so moving
+        # them one after the other never puts a deck into its own subtree in between
+        cur.executemany("INSERT INTO decks (name) VALUES (?) ON CONFLICT (name) DO NOTHING",
+                        [(deck["name"], ) for deck in changes["decks"]])
+        cur.executemany("UPDATE decks SET parent_id = NULL WHERE name = ?",
+                        [(deck["name"], ) for deck in changes["decks"]])
+        cur.executemany("UPDATE decks SET parent_id = (SELECT id FROM decks WHERE name = :parent) WHERE name = :name",
+                        changes["decks"])
+        # changes exported before the last review was stored don't have it, it's derived as in use_day_numbers then
+        cur.executemany(f"""
+            INSERT INTO cards
+                (title, filename, created_at, next_due_date, last_review, last_difficulty, last_interval, deck_id)
+            SELECT :title, :filename, {sql_day_number(":created_at")}, {sql_day_number(":next_due_date")},
+                   CASE WHEN :last_review IS NOT NULL THEN {sql_day_number(":last_review")}
+                        WHEN :last_difficulty IS NOT NULL THEN {sql_day_number(":next_due_date")} - :last_interval
+                   END,
+                   :last_difficulty, :last_interval, id
+            FROM decks WHERE name = :deck
+            ON CONFLICT (title) DO UPDATE SET
+                filename = excluded.filename,
+                created_at = excluded.created_at,
+                next_due_date = excluded.next_due_date,
+                last_review = excluded.last_review,
+                last_difficulty = excluded.last_difficulty,
+                last_interval = excluded.last_interval,
+                deck_id = excluded.deck_id""", [{"last_review": None, **card} for card in changes["cards"]])
+        cur.executemany("DELETE FROM cards WHERE title = ?", [(title, ) for title in changes["deleted_cards"]])
+        cur.executemany("DELETE FROM decks WHERE name = ?", [(name, ) for name in changes["deleted_decks"]])
+    remove_unreferenced_attachments()
 
-def rename_card(old_title, new_title):
+
+def rename_card(card, new_title):
     try:
-        db.cursor().execute("UPDATE cards set title=? where title=?", (new_title, old_title))
-        db.commit()
+        db.cursor().execute("UPDATE cards set title=? where id=?", (new_title, card))
+        _commit()
         return True
     except sqlite3.IntegrityError as e:
-        print(f"Caught an Exception while trying to rename card: {e}")
+        logger.warning("Caught an Exception while trying to rename card: %s", e)
         return False
 
 
-def delete_card(title):
-    file_name = db.execute("SELECT filename FROM cards WHERE title=?", (title, )).fetchall()[0][0]
-    os.remove(os.path.join(app_paths.app_data_path, file_name))
-    db.execute("DELETE FROM cards WHERE title=?", (title, ))
-    db.commit()
+def delete_card(card):
+    db.execute("DELETE FROM cards WHERE id=?", (card, ))
+    _commit()
+    remove_unreferenced_attachments()
+
 
 def get_decks():
     cur = db.cursor()
@@ -168,11 +1139,93 @@ def get_decks():
     return cur.fetchall()
 
 
-def delete_deck(deck):
+def get_deck_tree():
+    """Returns all decks (id, name, parent_id) with the number of due and total cards of the deck and all of its child
+    decks"""
+    roll_over_deck_counts()
     cur = db.cursor()
-    for card in get_cards(deck, include_children_cards=True, only_due=False):
-        if card["filename"]:
-            os.remove(os.path.join(app_paths.app_data_path, card["filename"]))
-    cur.execute("""DELETE FROM decks WHERE name=?""", (deck, ))
-    db.commit()
+    cur.execute("""
+        SELECT d.id, d.name, d.parent_id, k.due, k.total
+        FROM decks AS d
+        JOIN deck_counts AS k ON k.deck_id = d.id
+    """)
+    decks = {row["id"]: dict(row) for row in cur.fetchall()}
+
+    # order the decks from the top-level decks downwards, then add the counts of every deck to its parent bottom-up
+    children = dict()
+    for deck in decks.values():
+        children.setdefault(deck["parent_id"], []).append(deck["id"])
+    order = list(children.get(None, []))
+    for deck in order:
+        order.extend(children.get(deck, []))
+    for deck in reversed(order):
+        parent = decks[deck]["parent_id"]
+        if parent is not None:
+            decks[parent]["due"] += decks[deck]["due"]
+            decks[parent]["total"] += decks[deck]["total"]
+    return list(decks.values())
+
+
+def get_child_decks(parent=None, with_counts=True):
+    """Returns the direct child decks (id, name, parent_id) of the deck with the id parent (or the top-level decks),
+    each with its number of direct child decks and, with_counts, the number of due and total cards of the deck and all
+    of its child decks"""
+    if not with_counts:
+        cur = db.execute("""
+            SELECT d.id, d.name, d.parent_id, (SELECT COUNT(*) FROM decks AS c WHERE c.parent_id = d.id) AS children
+            FROM decks AS d
+            WHERE d.parent_id IS ?
+            ORDER BY d.id""", (parent, ))
+        return [dict(row) for row in cur.fetchall()]
+    roll_over_deck_counts()
+    cur = db.cursor()
+    cur.execute("""
+        SELECT d.id, d.name, d.parent_id,
+               SUM(k.due) AS due,
+               SUM(k.total) AS total,
+               (SELECT COUNT(*) FROM decks AS c WHERE c.parent_id = d.id) AS children
+        FROM decks AS d
+        JOIN deck_closure AS dc ON dc.ancestor = d.id
+        JOIN deck_counts AS k ON k.deck_id = dc.descendant
+        WHERE d.parent_id IS ?
+        GROUP BY d.id
+        ORDER BY d.id
+    """, (parent, ))
+    return [dict(row) for row in cur.fetchall()]
+
+
+def get_due_count(deck):
+    """Returns the number of due cards of the deck and all of its child decks"""
+    roll_over_deck_counts()
+    cur = db.cursor()
+    cur.execute(deck_tree_query + """
+        SELECT COALESCE(SUM(k.due), 0)
+        FROM deck_counts AS k
+        JOIN deck_tree AS dt ON k.deck_id = dt.id
+    """, (deck, ))
+    return cur.fetchone()[0]
+
+
+def delete_deck(deck):
+    db.execute("""DELETE FROM decks WHERE id=?""", (deck, ))
+    _commit()
+    remove_unreferenced_attachments()
+
+
+def get_attachment_names():
+    """Returns the names of all attached files that are used by a card"""
+    return [row[0] for row in db.execute("SELECT filename FROM attachments WHERE refcount > 0")]
+
+
+def remove_unreferenced_attachments():
+    """Removes the attached files no card uses anymore"""
+    with transaction():
+        file_names = [row[0] for row in db.execute("SELECT filename FROM attachments WHERE refcount <= 0")]
+        db.execute("DELETE FROM attachments WHERE refcount <= 0")
+    # only remove the files once the cards are gone for sure
+    for file_name in file_names:
+        try:
+            os.remove(os.path.join(get_data_dir(), file_name))
+        except FileNotFoundError:
+            pass
 
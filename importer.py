@@ -0,0 +1,151 @@
+import csv
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import attachments
+import db
+
+'''
+This file imports many cards at once, from a manifest (CSV or JSON) or from a folder of scores.
+
+A manifest lists the cards with their title, their deck and optionally the file to attach. Decks are given as paths
+like "Piano::Bach::Preludes": every part is a deck, and each one is the parent of the next. In a folder, every file
+becomes a card titled like the file and every folder a deck named like the folder.
+
+The files are copied into the attachment store on a pool of threads, then all decks and cards are added in a single
+transaction. Cards that can't be imported, e.g. because a card with the same title exists already or their deck
+exists already under another parent (deck names are unique), are skipped and reported, the rest is imported anyway.
+'''
+
+logger = logging.getLogger(__name__)
+
+DECK_SEPARATOR = "::"
+
+
+class ImportReport:
+    __slots__ = ("imported", "skipped")
+
+    def __init__(self):
+        self.imported = 0
+        # (title, reason) of every card that wasn't imported
+        self.skipped = []
+
+    @property
+    def duplicates(self):
+        return [title for title, reason in self.skipped if reason == "duplicate"]
+
+    def __str__(self):
+        lines = [f"Imported {self.imported} cards, skipped {len(self.skipped)}"]
+        lines += [f"  {title}: {reason}" for title, reason in self.skipped]
+        return "\n".join(lines)
+
+
+def read_manifest(manifest_file, deck=None):
+    """Reads the cards from a CSV file with the columns title, deck and file, or from a JSON file holding a list of
+    objects with these keys. Files are relative to the manifest, cards without a deck go into the given one. Returns
+    (deck path, title, file) tuples"""
+    if manifest_file.lower().endswith(".json"):
+        with open(manifest_file, encoding="utf-8") as file:
+            rows = json.load(file)
+    else:
+        # utf-8-sig, spreadsheet programs like to start the file with a byte order mark
+        with open(manifest_file, newline="", encoding="utf-8-sig") as file:
+            rows = list(csv.DictReader(file))
+    base_dir = os.path.dirname(os.path.abspath(manifest_file))
+    entries = []
+    for row in rows:
+        title = (row.get("title") or "").strip()
+        if not title:
+            continue
+        file_name = (row.get("file") or "").strip()
+        entries.append(((row.get("deck") or "").strip() or deck, title,
+                        os.path.join(base_dir, file_name) if file_name else None))
+    return entries
+
+
+def read_folder(folder, parent=None):
+    """Reads the cards from a folder of files, the folder itself becomes a child deck of parent (if given). Returns
+    (deck path, title, file) tuples"""
+    folder = os.path.abspath(folder)
+    root = os.path.basename(folder) if parent is None else parent + DECK_SEPARATOR + os.path.basename(folder)
+    entries = []
+    for dir_path, dir_names, file_names in os.walk(folder):
+        dir_names.sort()
+        relative = os.path.relpath(dir_path, folder)
+        deck = root if relative == os.curdir else DECK_SEPARATOR.join([root] + relative.split(os.sep))
+        for file_name in sorted(file_names):
+            # hidden files like .DS_Store
+            if not file_name.startswith("."):
+                entries.append((deck, os.path.splitext(file_name)[0], os.path.join(dir_path, file_name)))
+    return entries
+
+
+def decks_of(deck_paths):
+    """Returns the (name, parent) of every deck in the paths, parents first. The paths mustn't put the same name under
+    different parents (see deck_conflict)"""
+    decks = dict()
+    for path in deck_paths:
+        parent = None
+        for name in path.split(DECK_SEPARATOR):
+            decks.setdefault(name, parent)
+            parent = name
+    return list(decks.items())
+
+
+def deck_conflict(deck_path, parents):
+    """Returns why the cards of the deck path can't be imported if one of its decks exists under another parent, by
+    the parent names of the known decks. Otherwise returns None and adds the decks of the path to parents. The first
+    deck of a path is used wherever it is, that's how cards are imported into an existing deck"""
+    names = deck_path.split(DECK_SEPARATOR)
+    for parent, name in zip(names, names[1:]):
+        if name in parents and parents[name] != parent:
+            return f"deck {name} already exists under {parents[name] or 'the top level'}"
+    parents.setdefault(names[0], None)
+    for parent, name in zip(names, names[1:]):
+        parents[name] = parent
+    return None
+
+
+def import_cards(entries, max_workers=None):
+    """Imports the (deck path, title, file) cards returned by read_manifest or read_folder. Returns an ImportReport"""
+    report = ImportReport()
+    existing = db.get_existing_titles(title for _, title, _ in entries)
+    # the existing decks and the ones added by the accepted cards
+    parents = db.get_deck_parents()
+    titles = set()
+    accepted = []
+    for deck_path, title, file in entries:
+        if title in existing or title in titles:
+            report.skipped.append((title, "duplicate"))
+        elif not deck_path:
+            report.skipped.append((title, "no deck"))
+        elif conflict := deck_conflict(deck_path, parents):
+            report.skipped.append((title, conflict))
+        else:
+            titles.add(title)
+            accepted.append((deck_path, title, file))
+
+    # copy the files first, a card must never point to a file that isn't there
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="import") as executor:
+        stored = [executor.submit(attachments.store, file) if file else None for _, _, file in accepted]
+    cards = []
+    deck_paths = []
+    for (deck_path, title, file), future in zip(accepted, stored):
+        file_name = None
+        if future is not None:
+            try:
+                file_name = future.result()
+            except OSError as e:
+                report.skipped.append((title, f"file couldn't be copied: {e}"))
+                continue
+        cards.append((deck_path.split(DECK_SEPARATOR)[-1], title, file_name))
+        deck_paths.append(deck_path)
+
+    with db.transaction():
+        db.add_decks(decks_of(deck_paths))
+        db.add_cards(cards)
+    report.imported = len(cards)
+    logger.info("Imported %s cards, skipped %s", report.imported, len(report.skipped))
+    return report
@@ -0,0 +1,231 @@
+import bisect
+import functools
+import logging
+import re
+import sqlite3
+import time
+from collections import Counter
+
+import db
+
+'''
+This file measures what the db does, to find out why the app is slow for someone.
+
+Once enable() was called (before connecting), every statement run on the connection is timed and the rows it returned
+(or changed) are counted, grouped by the statement's SQL. A statement's time includes fetching its rows, as that's when
+SQLite does most of the work. Statements slower than slow_ms are logged right away together with their query plan, and
+every call of one of db's public functions is counted. report() sums it all up, slowest statements first.
+
+Nothing of this runs unless it's enabled, the db uses a plain connection by default.
+'''
+
+logger = logging.getLogger(__name__)
+
+# upper bounds (in ms) of the buckets of the latency histograms, the last bucket holds everything slower
+BUCKETS = (0.1, 0.5, 1, 5, 10, 50, 100, 500, 1000)
+# statements that took longer than this (in ms) are logged with their query plan
+slow_ms = 100
+enabled = False
+
+# the statistics per statement, by its SQL
+statements = dict()
+# the number of calls per function of db
+calls = Counter()
+
+
+class StatementStats:
+    __slots__ = ("executions", "total_ms", "max_ms", "rows", "histogram")
+
+    def __init__(self):
+        self.executions = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.rows = 0
+        self.histogram = [0] * (len(BUCKETS) + 1)
+
+    def add(self, ms, rows):
+        self.executions += 1
+        self.total_ms += ms
+        self.max_ms = max(self.max_ms, ms)
+        self.rows += rows
+        self.histogram[bisect.bisect_left(BUCKETS, ms)] += 1
+
+
+def normalize(sql):
+    """Collapses the whitespace, so a statement is always counted under the same key however it's indented"""
+    return re.sub(r"\s+", " ", sql).strip()
+
+
+def query_plan(connection, sql, parameters):
+    """Returns the lines of EXPLAIN QUERY PLAN for the statement, run on a plain cursor so it isn't measured itself"""
+    try:
+        rows = sqlite3.Cursor(connection).execute("EXPLAIN QUERY PLAN " + sql, parameters).fetchall()
+    except sqlite3.Error as e:
+        return [f"no query plan: {e}"]
+    return [row[-1] for row in rows]
+
+
+def record(connection, sql, parameters, ms, rows):
+    key = normalize(sql)
+    stats = statements.get(key)
+    if stats is None:
+        stats = statements[key] = StatementStats()
+    stats.add(ms, rows)
+    if ms >= slow_ms:
+        plan = []
+        if parameters is not None and not key.upper().startswith(("PRAGMA", "BEGIN", "COMMIT", "ROLLBACK")):
+            plan = query_plan(connection, sql, parameters)
+        logger.warning("Slow query (%.1f ms, %s rows): %s%s", ms, rows, key, "".join("\n  " + line for line in plan))
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """Times the statement it executes, from executing it until its last row was fetched"""
+    _sql = None
+    _parameters = None
+    _ms = 0.0
+    _rows = 0
+
+    def _start(self, sql, parameters, execute, *args):
+        self._finish()
+        start = time.perf_counter()
+        execute(self, sql, *args)
+        self._sql, self._parameters = sql, parameters
+        self._ms = (time.perf_counter() - start) * 1000
+        self._rows = 0
+        if self.description is None:
+            # nothing to fetch, the statement is done
+            self._rows = max(self.rowcount, 0)
+            self._finish()
+        return self
+
+    def _finish(self):
+        if self._sql is not None:
+            sql, self._sql = self._sql, None
+            record(self.connection, sql, self._parameters, self._ms, self._rows)
+
+    def _timed(self, fetch, *args):
+        start = time.perf_counter()
+        try:
+            return fetch(self, *args)
+        finally:
+            self._ms += (time.perf_counter() - start) * 1000
+
+    def execute(self, sql, parameters=()):
+        return self._start(sql, parameters, sqlite3.Cursor.execute, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        # the parameters may be a generator that's used up by now, there's no query plan for these
+        return self._start(sql, None, sqlite3.Cursor.executemany, seq_of_parameters)
+
+    def fetchone(self):
+        row = self._timed(sqlite3.Cursor.fetchone)
+        if row is not None:
+            self._rows += 1
+        else:
+            self._finish()
+        # otherwise the statement is recorded once the cursor runs the next one, is closed or goes away
+        return row
+
+    def fetchmany(self, size=None):
+        rows = self._timed(sqlite3.Cursor.fetchmany, self.arraysize if size is None else size)
+        self._rows += len(rows)
+        if len(rows) < (self.arraysize if size is None else size):
+            self._finish()
+        return rows
+
+    def fetchall(self):
+        rows = self._timed(sqlite3.Cursor.fetchall)
+        self._rows += len(rows)
+        self._finish()
+        return rows
+
+    def __next__(self):
+        try:
+            row = self._timed(sqlite3.Cursor.__next__)
+        except StopIteration:
+            self._finish()
+            raise
+        self._rows += 1
+        return row
+
+    def close(self):
+        self._finish()
+        super().close()
+
+    def __del__(self):
+        self._finish()
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    """A connection whose cursors are InstrumentedCursors, commits are measured as well"""
+
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def commit(self):
+        start = time.perf_counter()
+        try:
+            super().commit()
+        finally:
+            record(self, "COMMIT", None, (time.perf_counter() - start) * 1000, 0)
+
+
+def counted(function):
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        calls[function.__name__] += 1
+        return function(*args, **kwargs)
+    return wrapper
+
+
+def is_db_api(name, value):
+    """Whether the calls of a module-level name of db are counted: the public functions that use the connection. The
+    helpers (like the row factory, called for every row, or the date conversions) and the migrations aren't"""
+    return (callable(value) and getattr(value, "__module__", None) == db.__name__ and not isinstance(value, type)
+            and not name.startswith("_") and value not in db.migrations and "db" in value.__code__.co_names)
+
+
+def enable(slow_query_ms=None):
+    """Measures everything the db does from now on. Has to be called before db.connect_DB"""
+    global enabled, slow_ms
+    if slow_query_ms is not None:
+        slow_ms = slow_query_ms
+    if enabled:
+        return
+    enabled = True
+    db.connection_factory = InstrumentedConnection
+    # db's functions call each other through the module as well, so these calls are counted too
+    for name, value in list(vars(db).items()):
+        if is_db_api(name, value):
+            setattr(db, name, counted(value))
+
+
+def reset():
+    statements.clear()
+    calls.clear()
+
+
+def report(limit=20):
+    """Returns the statistics as text: the slowest statements (by their total time) with their latency histograms, and
+    the calls per function"""
+    lines = [f"{len(statements)} statements, {sum(s.executions for s in statements.values())} executions, "
+             f"{sum(s.total_ms for s in statements.values()):.1f} ms in total"]
+    labels = [f"<{bound:g}" for bound in BUCKETS] + [f">={BUCKETS[-1]:g}"]
+    for sql, stats in sorted(statements.items(), key=lambda item: item[1].total_ms, reverse=True)[:limit]:
+        lines.append("")
+        lines.append(sql if len(sql) <= 120 else sql[:117] + "...")
+        lines.append(f"  {stats.executions} executions, {stats.total_ms:.1f} ms total, "
+                     f"{stats.total_ms / stats.executions:.2f} ms mean, {stats.max_ms:.1f} ms max, {stats.rows} rows")
+        lines.append("  " + "  ".join(labels) + " ms")
+        lines.append("  " + "  ".join(f"{count:>{len(label)}}" for count, label in zip(stats.histogram, labels)))
+    if calls:
+        lines.append("")
+        lines.append("Calls per db function:")
+        lines += [f"  {name}: {count}" for name, count in calls.most_common()]
+    return "\n".join(lines)
@@ -0,0 +1,54 @@
+import logging
+import logging.handlers
+import queue
+
+'''
+This file sets up logging for the app and the command line.
+
+Every module logs to its own logger (logging.getLogger(__name__)), with the values passed as arguments so the message
+is only formatted if the record is actually written. The records are handed to a queue, and a background thread writes
+them to the log file (rotated once it gets too big) or to stderr, so logging never waits for the disk on the GUI thread
+or the worker. Debug records are dropped right away unless the level is set to DEBUG.
+'''
+
+LOG_FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+# the log file is rotated once it's this big, keeping this many old ones
+MAX_BYTES = 1 << 20
+BACKUP_COUNT = 3
+
+# the thread writing the records, while logging is set up
+listener = None
+
+
+def setup(log_file=None, level=logging.INFO):
+    """Sends all records of the level and above through a queue to a thread writing them into log_file, or to stderr if
+    there is none. Call shutdown before exiting, so the records still in the queue are written"""
+    global listener
+    if listener is not None:
+        shutdown()
+    if log_file is not None:
+        handler = logging.handlers.RotatingFileHandler(log_file, maxBytes=MAX_BYTES, backupCount=BACKUP_COUNT,
+                                                       encoding="utf-8")
+        handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    else:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter("%(levelname)s %(name)s: %(message)s"))
+    records = queue.SimpleQueue()
+    root = logging.getLogger()
+    for old_handler in root.handlers[:]:
+        root.removeHandler(old_handler)
+    root.addHandler(logging.handlers.QueueHandler(records))
+    root.setLevel(level)
+    listener = logging.handlers.QueueListener(records, handler)
+    listener.start()
+
+
+def shutdown():
+    """Writes the records still in the queue and stops the thread writing them"""
+    global listener
+    if listener is None:
+        return
+    listener.stop()
+    for handler in listener.handlers:
+        handler.close()
+    listener = None
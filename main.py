@@ -1,107 +1,140 @@
 #! /usr/bin/python3
 
-from appdata import AppDataPaths
-import db, algorithm
-import random
+import time
+# taken before anything else is imported, the startup time is measured from here
+start_time = time.perf_counter()
+
+import db, algorithm, logconfig
+from worker import Worker
+from models import DeckTreeModel, CardListModel, DECK_MIME_TYPE
 import sys
-import subprocess, os, platform
-import zipfile
+import os
 import logging
-import shutil
-from datetime import datetime, timedelta
+import json
+from datetime import datetime
 
 
 from PyQt6 import QtCore
-from PyQt6.QtCore import Qt
-from PyQt6.QtWidgets import QApplication, QMainWindow, QToolButton, QLabel, QMenu, QTreeView, QTabWidget, QWidget, QVBoxLayout, QHBoxLayout, QPushButton, QStackedWidget, QInputDialog, QMessageBox, QFileDialog, QAbstractItemView
-from PyQt6.QtGui import QStandardItemModel, QStandardItem, QFont, QAction
-
-app = QApplication(sys.argv)
-app_paths = AppDataPaths("repetition")
+from PyQt6.QtCore import Qt, QTimer
+from PyQt6.QtWidgets import QApplication, QMainWindow, QToolButton, QLabel, QMenu, QTreeView, QTabWidget, QWidget, QVBoxLayout, QHBoxLayout, QPushButton, QStackedWidget, QInputDialog, QMessageBox, QFileDialog, QAbstractItemView, QSpinBox
+from PyQt6.QtGui import QFont, QAction, QPixmap
 
+# the main window, created by main()
+window = None
 
 '''
 This file is main entry point of the application and handles most of the GUI stuff
 
+To get the window on the screen quickly, only the main page is built at startup and the counts of the decks are loaded
+after the decks themselves. The other pages are built when they're first shown, and the modules only needed for some
+actions (exporting, importing, opening files, ...) are imported when the action is used.
+
 @author: David Buehler
 @date: January/February/March 2023
 '''
 
+logger = logging.getLogger(__name__)
+
+
+# the names of the grades 1 to 4, as shown on the buttons of the study page
+GRADE_NAMES = ("Forgot", "Hard", "Good", "Easy")
+# the previews of the files of this many cards ahead in the queue are rendered while the current card is studied
+PREFETCH_COUNT = 3
+
+
+def interval_text(next_due_date):
+    """Describes when a card would be due again, for the buttons of the study page"""
+    days = (next_due_date - datetime.now().date()).days
+    if days <= 0:
+        return "today"
+    if days == 1:
+        return "tomorrow"
+    return f"in {days} days"
+
 
 class MainWindow(QWidget):
     current_card = None
+    # what each grade would do to the current card, by grade (see studyqueue.outcomes), calculated when it's shown
+    current_outcomes = None
+    # the id and name of the deck that is being studied or edited
     active_deck = None
-    due_cards = None
-
-    stackedWidget = QStackedWidget()
+    active_deck_name = None
+    study_queue = None
+    # the files of the session whose previews were rendered or are about to be
+    prefetched_files = None
+    # the maximum number of due cards studied in one session, None for all of them
+    session_limit = None
 
     study_page = {
         "title_label": None,
         "created_at_label": None,
-        "btn_open_file": None
+        "preview_label": None,
+        "btn_open_file": None,
+        "grade_buttons": None
     }
     deck_list = None
 
     card_list = None
+    study_page_widget = None
+    edit_page_widget = None
 
-    def __init__(self):
+    def __init__(self, report_startup_time=False, profile=False):
         super().__init__()
+        # with --profile, the db's statistics (see instrumentation) can be shown from the main page
+        self.profile = profile
+        # everything touching the db or the attachments runs on the worker's background thread
+        self.worker = Worker()
+        # the previews of attached files are rendered on a thread of their own (see thumbnails)
+        self.preview_worker = Worker("previews")
+        # exports only use the worker for the db snapshot, the files are written on a thread of their own
+        self.export_worker = Worker("export")
+        self.stackedWidget = QStackedWidget()
+        self.worker.submit(db.connect_DB)
+        self.worker.submit(db.get_parameters, callback=algorithm.use_parameters)
+        # the decks are fetched by the model as soon as the view asks for them
+        self.deck_model = DeckTreeModel(self.worker)
         self.setWindowTitle('Repetition - All Decks')
         main_layout = QHBoxLayout()
         self.setLayout(main_layout)
         main_page = QWidget()
-        main_page.setLayout(self.create_main_layout(self.get_deck_item_model()))
+        main_page.setLayout(self.create_main_layout(self.deck_model))
         self.stackedWidget.addWidget(main_page)
-        study_page = QWidget()
-        study_page.setLayout(self.create_study_layout())
-        self.stackedWidget.addWidget(study_page)
-        edit_page = QWidget()
-        edit_page.setLayout(self.create_edit_layout())
-        self.stackedWidget.addWidget(edit_page)
         main_layout.addWidget(self.stackedWidget)
+
+        # milliseconds since start_time until the window was painted and until the decks were shown with their counts
+        self.startup_times = dict()
+        self.report_startup_time = report_startup_time
+        self.deck_model.counts_loaded.connect(self.on_deck_counts_loaded)
         self.show()
+        # runs once the event loop is idle for the first time, after the window was painted
+        QTimer.singleShot(0, lambda: self.record_startup_time("first_paint_ms"))
 
-    @staticmethod
-    def get_deck_item_model():
-        print("[I] Scanning for decks")
-        decks = db.get_decks()
-        model = QStandardItemModel()
-        model.setHorizontalHeaderLabels(['Decks'])
-        root_item = model.invisibleRootItem()
-
-        items = dict()
-
-        bold_font = QFont()
-        bold_font.setBold(True)
-
-        for deck in decks:
-            print(f"[D] Found deck: {deck['name']}")
-            item = QStandardItem(deck['name'])
-            if len(db.get_cards(deck['name'], only_due=True)) == 0:
-                item.setEditable(False)
-            else:
-                item.setFont(bold_font)
-            items[deck["name"]] = item
-
-        for deck in decks:
-            if deck["parent"] == None:
-                root_item.appendRow(items[deck["name"]])
-            else:
-                items[deck["parent"]].appendRow(items[deck["name"]])
-        return model
-
-    def get_cards_item_model(self, deck):
-        cards = db.get_cards(deck, include_children_cards=False, only_due=False)
-        model = QStandardItemModel()
-        model.dataChanged.connect(self.on_card_renamed)
-        model.setHorizontalHeaderLabels(['Cards'])
-        root_item = model.invisibleRootItem()
-
-        for card in cards:
-            item = QStandardItem(card['title'])
-            item.setData(card['title'], Qt.ItemDataRole.DisplayRole.UserRole)
-            root_item.appendRow(item)
-        return model
+    def record_startup_time(self, name):
+        if name in self.startup_times:
+            return
+        self.startup_times[name] = round((time.perf_counter() - start_time) * 1000, 1)
+        logger.info("Startup: %s = %s", name, self.startup_times[name])
+        if self.report_startup_time and len(self.startup_times) == 2:
+            # sys.stdout is redirected to the log
+            print(json.dumps(self.startup_times), file=sys.__stdout__, flush=True)
+            QApplication.instance().quit()
+
+    def on_deck_counts_loaded(self):
+        self.record_startup_time("decks_ms")
+
+    def show_study_page(self):
+        if self.study_page_widget is None:
+            self.study_page_widget = QWidget()
+            self.study_page_widget.setLayout(self.create_study_layout())
+            self.stackedWidget.addWidget(self.study_page_widget)
+        self.stackedWidget.setCurrentWidget(self.study_page_widget)
+
+    def show_edit_page(self):
+        if self.edit_page_widget is None:
+            self.edit_page_widget = QWidget()
+            self.edit_page_widget.setLayout(self.create_edit_layout())
+            self.stackedWidget.addWidget(self.edit_page_widget)
+        self.stackedWidget.setCurrentWidget(self.edit_page_widget)
 
     def create_main_layout(self, model):
         # Create a vertical layout to hold the horizontal layout and the tree view
@@ -125,6 +158,13 @@ class MainWindow(QWidget):
         btn_createCard.clicked.connect(self.create_card)
         button_layout.addWidget(btn_createCard)
 
+        btn_import_cards = QPushButton('Import Cards')
+        import_menu = QMenu(btn_import_cards)
+        import_menu.addAction('From CSV/JSON File...', self.import_cards_from_manifest)
+        import_menu.addAction('From Folder...', self.import_cards_from_folder)
+        btn_import_cards.setMenu(import_menu)
+        button_layout.addWidget(btn_import_cards)
+
         btn_import = QPushButton('Import')
         btn_import.clicked.connect(self.import_from_file)
         button_layout.addWidget(btn_import)
@@ -133,6 +173,22 @@ class MainWindow(QWidget):
         btn_export.clicked.connect(self.export)
         button_layout.addWidget(btn_export)
 
+        btn_export_changes = QPushButton('Export Changes')
+        btn_export_changes.clicked.connect(self.export_changes)
+        button_layout.addWidget(btn_export_changes)
+
+        if self.profile:
+            btn_db_stats = QPushButton('DB Statistics')
+            btn_db_stats.clicked.connect(self.show_db_statistics)
+            button_layout.addWidget(btn_db_stats)
+
+        spin_session_limit = QSpinBox()
+        spin_session_limit.setPrefix("Cards per session: ")
+        spin_session_limit.setRange(0, 9999)
+        spin_session_limit.setSpecialValueText("No session limit")
+        spin_session_limit.valueChanged.connect(self.on_session_limit_changed)
+        button_layout.addWidget(spin_session_limit)
+
         button_layout.addStretch()
 
         # Add the horizontal layout to the vertical layout
@@ -154,6 +210,10 @@ class MainWindow(QWidget):
         created_at_label = QLabel('Created at {created_at}')
         self.study_page["created_at_label"] = created_at_label
         layout.addWidget(created_at_label)
+        preview_label = QLabel()
+        preview_label.setAlignment(Qt.AlignmentFlag.AlignCenter)
+        self.study_page["preview_label"] = preview_label
+        layout.addWidget(preview_label)
         layout.addStretch()
 
         # Above the difficulty buttons, there's a row with "management buttons"
@@ -173,18 +233,13 @@ class MainWindow(QWidget):
         # Create a horizontal layout to hold the difficulty buttons
         button_layout = QHBoxLayout()
         button_layout.addStretch()
-        btn_again = QPushButton('Forgot')
-        btn_again.clicked.connect(lambda: self.on_difficulty_button_clicked(1))
-        button_layout.addWidget(btn_again)
-        btn_hard = QPushButton('Hard')
-        btn_hard.clicked.connect(lambda: self.on_difficulty_button_clicked(2))
-        button_layout.addWidget(btn_hard)
-        btn_good = QPushButton('Good')
-        btn_good.clicked.connect(lambda: self.on_difficulty_button_clicked(3))
-        button_layout.addWidget(btn_good)
-        btn_easy = QPushButton('Easy')
-        btn_easy.clicked.connect(lambda: self.on_difficulty_button_clicked(4))
-        button_layout.addWidget(btn_easy)
+        grade_buttons = []
+        for grade, name in enumerate(GRADE_NAMES, start=1):
+            btn_grade = QPushButton(name)
+            btn_grade.clicked.connect(lambda _, grade=grade: self.on_difficulty_button_clicked(grade))
+            button_layout.addWidget(btn_grade)
+            grade_buttons.append(btn_grade)
+        self.study_page["grade_buttons"] = grade_buttons
         button_layout.addStretch()
         button_layout.setAlignment(self, QtCore.Qt.AlignmentFlag.AlignBottom)
         layout.addLayout(button_layout)
@@ -206,6 +261,9 @@ class MainWindow(QWidget):
         btn_delete_card = QPushButton('Delete Card')
         btn_delete_card.clicked.connect(self.on_delete_card_clicked)
         management_layout.addWidget(btn_delete_card)
+        btn_catch_up = QPushButton('Catch Up')
+        btn_catch_up.clicked.connect(self.on_catch_up_clicked)
+        management_layout.addWidget(btn_catch_up)
         management_layout.addStretch()
         layout.addLayout(management_layout)
 
@@ -214,41 +272,61 @@ class MainWindow(QWidget):
         return layout
 
     def update_study_layout(self):
-        self.study_page["title_label"].setText(self.current_card["title"])
-        self.study_page["created_at_label"].setText(f"Created at {self.current_card['created_at']}")
-        self.study_page["btn_open_file"].setEnabled(self.current_card["filename"] is not None)
+        self.study_page["title_label"].setText(self.current_card.title)
+        self.study_page["created_at_label"].setText(f"Created at {db.to_date(self.current_card.created_at)}")
+        self.study_page["btn_open_file"].setEnabled(self.current_card.filename is not None)
+        self.study_page["preview_label"].clear()
+        # show when the card would be due again for each grade
+        for (grade, name), button in zip(enumerate(GRADE_NAMES, start=1), self.study_page["grade_buttons"]):
+            button.setText(f"{name}\n{interval_text(self.current_outcomes[grade][2])}")
 
     # Click actions
     def on_file_open_clicked(self):
-        filepath = os.path.join(db.app_paths.app_data_path, self.current_card["filename"])
+        import attachments, platform, subprocess
+        filepath = attachments.path(self.current_card.filename)
+        # don't wait for the viewer, it would block the GUI thread
         if platform.system() == 'Darwin':       # macOS
-            subprocess.call(('open', filepath))
+            subprocess.Popen(('open', filepath))
         elif platform.system() == 'Windows':    # Windows
             os.startfile(filepath)
         else:                                   # linux variants
-            subprocess.call(('xdg-open', filepath))
+            subprocess.Popen(('xdg-open', filepath))
 
-    @staticmethod
-    def export():
+    def export(self):
         zip_file_name, _ = QFileDialog.getSaveFileName(None, "Save Zip File", "", "Zip Files (*.zip)")
         if zip_file_name:
-            print(f"[D] Selected file path: {zip_file_name}")
-            with zipfile.ZipFile(zip_file_name, "w") as zip_archive:
-                # Iterate through the files in the directory
-                for file_name in os.listdir(app_paths.app_data_path):
-                    if file_name not in ["locks", "logs"]:
-                        # Construct the full path to the file
-                        file_path = os.path.join(app_paths.app_data_path, file_name)
-                        # Add the file to the zip archive
-                        zip_archive.write(file_path, arcname=file_name)
-                    else:
-                        print(f"[D] {file_name} was ignored and not added to the archive")
-
-            print(f"Files added to {zip_file_name} successfully!")
+            logger.debug("Selected file path: %s", zip_file_name)
+            import archive
+            self.export_worker.submit(archive.export_archive, zip_file_name, run=self.worker.call,
+                                      callback=lambda _: logger.info("Files added to %s successfully!", zip_file_name),
+                                      error_callback=lambda e: QMessageBox.critical(None, "Error", f"Export failed.\nReason: {e}"))
+
+    def export_changes(self):
+        zip_file_name, _ = QFileDialog.getSaveFileName(None, "Save Zip File", "", "Zip Files (*.zip)")
+        if zip_file_name:
+            logger.debug("Selected file path: %s", zip_file_name)
+            import archive
+            self.export_worker.submit(archive.export_delta, zip_file_name, run=self.worker.call,
+                                      callback=lambda changed: logger.info("%s changes added to %s", changed, zip_file_name),
+                                      error_callback=lambda e: QMessageBox.critical(None, "Error", f"Export failed.\nReason: {e}"))
+
+    def show_db_statistics(self):
+        import instrumentation
+        # the statistics are written on the worker, so they're read there as well
+        self.worker.submit(instrumentation.report, callback=self.on_db_statistics_loaded)
+
+    @staticmethod
+    def on_db_statistics_loaded(report):
+        msg_box = QMessageBox()
+        msg_box.setWindowTitle("DB Statistics")
+        msg_box.setText(report.split("\n", 1)[0])
+        msg_box.setDetailedText(report)
+        msg_box.exec()
 
     def import_from_file(self):
         msg_box = QMessageBox()
-        msg_box.setText("This will replace all your decks and cards with the imported archive. Continue?")
+        msg_box.setText("This will replace all your decks and cards with the imported archive (or, if it only contains "
+                        "changes, merge them into your decks and cards). Continue?")
         msg_box.setStandardButtons(QMessageBox.StandardButton.Yes | QMessageBox.StandardButton.No)
         msg_box.setDefaultButton(QMessageBox.StandardButton.No)
 
@@ -256,35 +334,72 @@ class MainWindow(QWidget):
         if result == QMessageBox.StandardButton.Yes:
             zip_file_name, ok = QFileDialog.getOpenFileName(None, "Choose file", "", "Zip Files (*.zip)")
             if ok and zip_file_name:
-                try:
-                    with zipfile.ZipFile(zip_file_name, "r") as zip_archive:
-                        if "cards.db" in zip_archive.namelist():
-                            db.close()
-                            # extract the archive
-                            zip_archive.extractall(app_paths.app_data_path)
-                            # re-open the connection
-                            db.connect_DB()
-                            # update layout
-                            self.deck_list.setModel(self.get_deck_item_model())
-                            QMessageBox.information(None, "Information", "Import successful.")
-                        else:
-                            QMessageBox.critical(None, "Error", "Selected archive is not valid.\nReason: Missing database")
-                except zipfile.BadZipFile as e:
-                    QMessageBox.critical(None, "Error", f"Import failed.\nReason: {e}")
+                import archive
+                self.worker.submit(archive.import_archive, zip_file_name, callback=self.on_imported,
+                                   error_callback=lambda e: QMessageBox.critical(None, "Error", f"Import failed.\nReason: {e}"))
+
+    def import_cards_from_manifest(self):
+        manifest_file, ok = QFileDialog.getOpenFileName(None, "Choose file", "", "Card Lists (*.csv *.json)")
+        if ok and manifest_file:
+            import importer
+            # cards without a deck go into the selected one
+            _, deck = self.selected_deck()
+            self.worker.submit(lambda: importer.import_cards(importer.read_manifest(manifest_file, deck)),
+                               callback=self.on_cards_imported,
+                               error_callback=lambda e: QMessageBox.critical(None, "Error", f"Import failed.\nReason: {e}"))
+
+    def import_cards_from_folder(self):
+        folder = QFileDialog.getExistingDirectory(None, "Choose folder")
+        if folder:
+            import importer
+            # the folder becomes a child deck of the selected one
+            _, deck = self.selected_deck()
+            self.worker.submit(lambda: importer.import_cards(importer.read_folder(folder, deck)),
+                               callback=self.on_cards_imported,
+                               error_callback=lambda e: QMessageBox.critical(None, "Error", f"Import failed.\nReason: {e}"))
+
+    def on_cards_imported(self, report):
+        # new decks can show up anywhere in the tree
+        self.deck_model.reload()
+        message = f"Imported {report.imported} cards."
+        if report.skipped:
+            skipped = "\n".join(f"{title}: {reason}" for title, reason in report.skipped[:20])
+            if len(report.skipped) > 20:
+                skipped += f"\n... and {len(report.skipped) - 20} more"
+            message += f"\n\nSkipped {len(report.skipped)} cards:\n{skipped}"
+        QMessageBox.information(None, "Information", message)
+
+    def on_imported(self, valid):
+        if valid:
+            # update layout
+            self.deck_model.reload()
+            QMessageBox.information(None, "Information", "Import successful.")
+        else:
+            QMessageBox.critical(None, "Error", "Selected archive is not valid.\nReason: Missing database")
+
+    def selected_deck(self):
+        """Returns the id and name of the deck selected in the deck tree, (None, None) if there is none"""
+        index = self.deck_list.currentIndex()
+        if not index.isValid():
+            return None, None
+        node = self.deck_model.node(index)
+        return node.id, node.name
 
     def on_edit_deck_clicked(self):
-        deck = self.deck_list.model().data(self.deck_list.currentIndex(), QtCore.Qt.ItemDataRole.DisplayRole)
+        deck, name = self.selected_deck()
         if deck is None:
             QMessageBox.critical(None, "Error", "Select a deck first to proceed.")
             return
-        print(f"[I] Editing {deck}")
-        self.active_deck = deck
-        self.setWindowTitle(f"Repetition - Editing {deck}")
-        self.stackedWidget.setCurrentIndex(2)
+        logger.info("Editing %s", name)
+        self.active_deck, self.active_deck_name = deck, name
+        self.setWindowTitle(f"Repetition - Editing {name}")
+        self.show_edit_page()
         self.update_edit_layout()
 
     def update_edit_layout(self):
-        self.card_list.setModel(self.get_cards_item_model(self.active_deck))
+        model = CardListModel(self.worker, self.active_deck)
+        model.rename_failed.connect(self.on_card_rename_failed)
+        self.card_list.setModel(model)
 
     def on_delete_deck_clicked(self):
         msg_box = QMessageBox()
@@ -295,24 +410,34 @@ class MainWindow(QWidget):
         # execute the message box and get the result
         result = msg_box.exec()
         if result == QMessageBox.StandardButton.Yes:
-            db.delete_deck(self.active_deck)
-            self.return_to_main_screen()
+            self.worker.submit(db.delete_deck, self.active_deck, callback=lambda _: self.on_deck_deleted())
+
+    def on_deck_deleted(self):
+        self.deck_model.remove_deck(self.active_deck)
+        self.return_to_main_screen()
 
     def on_rename_deck_clicked(self):
-        new_name, ok = QInputDialog.getText(None, 'Enter new Name', 'Enter the new name:', text=self.active_deck)
+        new_name, ok = QInputDialog.getText(None, 'Enter new Name', 'Enter the new name:', text=self.active_deck_name)
 
         if ok and new_name:
-            print(f"[I] deck {self.active_deck} was renamed to {new_name}")
-            db.rename_deck(self.active_deck, new_name)
-            self.active_deck = new_name
-            self.setWindowTitle(f"Repetition - Editing {self.active_deck}")
-            self.update_edit_layout()
+            self.worker.submit(db.rename_deck, self.active_deck, new_name,
+                               callback=lambda success: self.on_deck_renamed(new_name, success))
+
+    def on_deck_renamed(self, new_name, success):
+        if not success:
+            QMessageBox.critical(None, "Error", "A deck with that name already exists.")
+            return
+        logger.info("deck %s was renamed to %s", self.active_deck_name, new_name)
+        self.deck_model.rename_deck(self.active_deck, new_name)
+        self.active_deck_name = new_name
+        self.setWindowTitle(f"Repetition - Editing {self.active_deck_name}")
 
     def on_delete_card_clicked(self):
-        card = self.card_list.model().data(self.card_list.currentIndex(), QtCore.Qt.ItemDataRole.DisplayRole)
-        if card is None:
+        index = self.card_list.currentIndex()
+        if not index.isValid():
             QMessageBox.critical(None, "Error", "Select a card first to proceed.")
             return
+        card = self.card_list.model().card_id(index)
 
         msg_box = QMessageBox()
         msg_box.setText("Are you sure?")
@@ -322,36 +447,45 @@ class MainWindow(QWidget):
         # execute the message box and get the result
         result = msg_box.exec()
         if result == QMessageBox.StandardButton.Yes:
-            db.delete_card(card)
-            self.update_edit_layout()
+            model = self.card_list.model()
+            self.worker.submit(db.delete_card, card, callback=lambda _: model.remove_card(card))
 
-    def on_card_renamed(self, index):
-        if index.column() == 0 and index.data(Qt.DisplayRole):
-            item = self.card_list.model().itemFromIndex(index)
-            new_name = item.text()
-            previous_name = item.data(Qt.ItemDataRole.DisplayRole.UserRole)
+    def on_catch_up_clicked(self):
+        days, ok = QInputDialog.getInt(None, 'Catch Up', f'Spread the due cards of {self.active_deck_name} over how '
+                                       'many days?', value=7, min=1, max=365)
+        if ok:
+            import studyqueue
+            self.worker.submit(studyqueue.catch_up, self.active_deck, days,
+                               callback=lambda count: self.on_caught_up(count, days))
 
-            print(f"[I] Item {previous_name} was renamed to {new_name}")
-            if not db.rename_card(previous_name, new_name):
-                QMessageBox.critical(None, "Error", "Couldn't rename card. Most likely, a card with that name already exists.")
-            self.update_edit_layout()
+    def on_caught_up(self, count, days):
+        self.deck_model.refresh_counts()
+        QMessageBox.information(None, "Information", f"Spread {count} due cards over the next {days} days.")
+
+    @staticmethod
+    def on_card_rename_failed(previous_title, new_title):
+        logger.info("Item %s couldn't be renamed to %s", previous_title, new_title)
+        QMessageBox.critical(None, "Error", "Couldn't rename card. Most likely, a card with that name already exists.")
 
     def create_deck(self):
         name, ok = QInputDialog.getText(self, 'Enter Name', "Enter the deck's name:")
         if ok and name:
-            if not db.add_deck(name):
-                QMessageBox.critical(None, "Error", "A deck with that name already exists.")
-            else:
-                # Update deck list
-                self.deck_list.setModel(self.get_deck_item_model())
+            self.worker.submit(db.add_deck, name, callback=lambda deck: self.on_deck_added(deck, name))
+
+    def on_deck_added(self, deck, name):
+        if deck is None:
+            QMessageBox.critical(None, "Error", "A deck with that name already exists.")
+        else:
+            # Update deck list
+            self.deck_model.add_deck(deck, name)
 
     def create_card(self):
-        deck = self.deck_list.model().data(self.deck_list.currentIndex(), QtCore.Qt.ItemDataRole.DisplayRole)
+        deck, name = self.selected_deck()
         if deck is None:
             QMessageBox.critical(None, "Error", "Select a deck first to proceed.")
             return
-        print(f"[I] Adding card to {deck}")
-        title, ok = QInputDialog.getText(self, f'Add to {deck}', "Enter the card's title:")
+        logger.info("Adding card to %s", name)
+        title, ok = QInputDialog.getText(self, f'Add to {name}', "Enter the card's title:")
         if ok and title:
             msg_box = QMessageBox()
             msg_box.setText("Do you want to attach a file?")
@@ -360,87 +494,127 @@ class MainWindow(QWidget):
 
             # execute the message box and get the result
             result = msg_box.exec()
-            file_name, source_file, dest_file = None, None, None
+            source_file = None
             if result == QMessageBox.StandardButton.Yes:
                 file_dialog = QFileDialog()
                 source_file, ok = file_dialog.getOpenFileName(window, "Choose file", "", "All Files (*)")
-
-                if ok and source_file:
-                    # import file
-                    # to make it possible for two files to have the same name,
-                    # the file name is prepended with the hash of the card's
-                    # title.
-                    file_name = str(hash(title)) + "_" + os.path.basename(source_file)
-                    dest_file = os.path.join(app_paths.app_data_path, file_name)
-            if not db.add_card(deck, title, file_name):
-                QMessageBox.critical(None, "Error", "A card with that title already exists.")
-            else:
-                if dest_file is not None:
-                    print(f"[I] Importing {file_name}")
-                    # Import the file. Only import it now since importing it with an already existing card could
-                    # lead to the card's file being overwritten, if the new file has the same file name
-                    shutil.copy2(source_file, dest_file)
-                # Update deck list
-                self.deck_list.setModel(self.get_deck_item_model())
-
-    def study(self, deck):
-        self.active_deck = deck
-        print(f"[I] Studying {self.active_deck}")
-        self.due_cards = db.get_cards(self.active_deck, only_due=True)
-        print(f"[I] There are {len(self.due_cards)} due cards in this deck")
-        random.shuffle(self.due_cards)
-        if self.due_cards:
-            self.setWindowTitle(f'Repetition - {self.active_deck}')
-            # get the first card
-            self.current_card = self.due_cards[0]
-            # and remove it from the queue
-            self.due_cards.remove(self.current_card)
-
-            self.update_study_layout()
-
-            self.stackedWidget.setCurrentIndex(1)
+                if not ok:
+                    source_file = None
+
+            import attachments
+
+            def add_card():
+                # files are stored under the hash of their content, so the same file is only stored once
+                file_name = attachments.file_name(source_file) if source_file else None
+                # the card is only committed once its file was copied, if copying fails the card is rolled back
+                with db.transaction():
+                    if db.add_card(deck, title, file_name) is None:
+                        return False
+                    if file_name is not None:
+                        logger.info("Importing %s as %s", source_file, file_name)
+                        attachments.store(source_file, file_name)
+                return True
+            self.worker.submit(add_card, callback=self.on_card_added,
+                               error_callback=lambda e: QMessageBox.critical(None, "Error", f"Adding the card failed.\nReason: {e}"))
+
+    def on_card_added(self, success):
+        if not success:
+            QMessageBox.critical(None, "Error", "A card with that title already exists.")
+        else:
+            # Update deck list
+            self.deck_model.refresh_counts()
+
+    def study(self, deck, name):
+        self.active_deck, self.active_deck_name = deck, name
+        logger.info("Studying %s", name)
+        import studyqueue
+        self.study_queue = studyqueue.StudyQueue(self.session_limit)
+        self.prefetched_files = set()
+        self.worker.submit(self.study_queue.load, deck, callback=self.on_due_cards_loaded)
+
+    def on_due_cards_loaded(self, due_count):
+        logger.info("There are %s due cards in this deck", due_count)
+        if due_count:
+            self.setWindowTitle(f'Repetition - {self.active_deck_name}')
+            self.next_card()
         else:
             QMessageBox.information(None, "Information", "This deck does not have any due cards.")
 
+    def on_session_limit_changed(self, value):
+        self.session_limit = value or None
+
     def return_to_main_screen(self):
+        self.study_queue = None
+        self.current_card = None
+        self.current_outcomes = None
         self.setWindowTitle('Repetition - All Decks')
-        # refresh decks
-        self.deck_list.setModel(self.get_deck_item_model())
+        # refresh the due counts of the decks
+        self.deck_model.refresh_counts()
         # show main screen
         self.stackedWidget.setCurrentIndex(0)
 
     def next_card(self):
-        if self.due_cards is not None and len(self.due_cards) > 0:
-            print(f"[I] There are {len(self.due_cards)} cards left to study")
-            self.current_card = self.due_cards[0]
-            self.due_cards.remove(self.current_card)
-            self.update_study_layout()
-        else:
-            print("[I] No due cards left")
+        self.current_card = None
+        self.current_outcomes = None
+        study_queue = self.study_queue
+        # the outcomes of all grades are calculated on the worker along with loading the card
+        self.worker.submit(study_queue.pop_with_outcomes,
+                           callback=lambda result: self.on_card_popped(study_queue, *result))
+
+    def on_card_popped(self, study_queue, card, outcomes):
+        if study_queue is not self.study_queue:
+            # the session was cancelled in the meantime
+            return
+        if card is None:
+            logger.info("No due cards left")
             self.return_to_main_screen()
+            return
+        logger.info("There are %s cards left to study", len(self.study_queue))
+        self.current_card = card
+        self.current_outcomes = outcomes
+        self.show_study_page()
+        self.update_study_layout()
+        self.load_previews()
+
+    def load_previews(self):
+        """Shows the preview of the current card's file once it's rendered, and renders the previews of the next cards'
+        files in the meantime, so they're shown right away when it's their turn"""
+        import thumbnails
+        card = self.current_card
+        if card.filename is not None:
+            self.prefetched_files.add(card.filename)
+            self.preview_worker.submit(thumbnails.preview, card.filename,
+                                       callback=lambda preview_file: self.on_preview_rendered(card, preview_file))
+        study_queue = self.study_queue
+        self.worker.submit(study_queue.upcoming_files, PREFETCH_COUNT,
+                           callback=lambda file_names: self.prefetch_previews(study_queue, file_names))
+
+    def prefetch_previews(self, study_queue, file_names):
+        if study_queue is not self.study_queue:
+            return
+        import thumbnails
+        for file_name in file_names:
+            if file_name not in self.prefetched_files:
+                self.prefetched_files.add(file_name)
+                self.preview_worker.submit(thumbnails.preview, file_name)
 
-    def on_difficulty_button_clicked(self, grade):
-        # get the necessary parameters
-        s_i = self.current_card["last_interval"] or 0
-        next_due_date = datetime.strptime(self.current_card["next_due_date"], "%Y-%m-%d")
-        # the card was last studied at due date - last stability
-        delta_t = (datetime.today().date() - (next_due_date.date() - timedelta(days=s_i))).days
-        d_i = self.current_card["last_difficulty"]
-        new_card = d_i is None
-
-        print(f"[D] delta_t = {delta_t}")
-
-        # Run algorithm
-        stability, difficulty = algorithm.calculate_stability_difficulty(s_i, delta_t, d_i, grade, new_card)
-
-        # Debug prints
-        print(f"[D] algorithm returned: d_i+1 = {difficulty}, s_i+1 = {stability}")
+    def on_preview_rendered(self, card, preview_file):
+        if card is self.current_card and preview_file is not None:
+            self.study_page["preview_label"].setPixmap(QPixmap(preview_file))
 
-        # Update values
-        next_due_date = next_due_date.date() + timedelta(days=stability)
-        db.update_card_after_review(self.current_card["title"], difficulty, stability, next_due_date)
+    def on_difficulty_button_clicked(self, grade):
+        if self.current_card is None:
+            # the next card is still being loaded
+            return
+        stability, difficulty, next_due_date, delta_t = self.current_outcomes[grade]
+        # the worker runs the update before anything submitted afterwards, no need to wait for it
+        self.worker.submit(db.update_card_after_review, self.current_card.id, difficulty, stability, next_due_date,
+                           grade, delta_t)
 
-        print(f"[I] DB updated, card is due again at {next_due_date}")
+        logger.info("DB update queued, card is due again at %s", next_due_date)
+        if grade == 1:
+            # study the card again later in this session
+            self.worker.submit(self.study_queue.requeue, self.current_card.id)
 
         self.next_card()
 
@@ -456,64 +630,100 @@ class DeckView(QTreeView):
         self.setDragDropMode(QAbstractItemView.DragDropMode.InternalMove)
 
     def dropEvent(self, event):
-        print("[D] Handling drop event")
+        logger.debug("Handling drop event")
+        # The model moves the deck itself once the db is updated, the view must neither move nor remove any rows
+        event.setDropAction(Qt.DropAction.IgnoreAction)
+        event.accept()
+        if not event.mimeData().hasFormat(DECK_MIME_TYPE):
+            return
 
-        fake_model = QStandardItemModel()
-        fake_model.dropMimeData(
-            event.mimeData(), event.dropAction(), 0, 0, QtCore.QModelIndex()
-        )
-        child = fake_model.index(0, 0).data()
+        child = int(bytes(event.mimeData().data(DECK_MIME_TYPE)).decode())
         to_index = self.indexAt(event.position().toPoint())
+        parent = None
         if to_index.isValid():
-            if to_index.data() == child:
-                print("[I] deck droppped onto itself, no change performed")
-                super().dropEvent(event)
+            parent = self.model().node(to_index).id
+            if parent == child:
+                logger.info("deck droppped onto itself, no change performed")
                 return
             # parent is a deck
-            print(f"[I] Changing parent of {child} to {to_index.data()}")
-            db.change_deck_parent(child, to_index.data())
+            # Currently, a re-ordering is also considered as a drop onto a deck
+            logger.info("Changing parent of %s to %s", child, parent)
         else:
             # no parent - dropped into the void
-            print(f"[I] Setting parent of {child} to NULL")
-            db.change_deck_parent(child)
+            logger.info("Setting parent of %s to NULL", child)
+        self.main_window.worker.submit(db.change_deck_parent, child, parent,
+                                       callback=lambda success: self.on_deck_moved(child, parent, success))
 
-        super().dropEvent(event)
-        # Currently, a re-ordering is also considered as a drop onto a deck
-        # To reflect that on the UI, update it
-        self.setModel(self.main_window.get_deck_item_model())
+    def on_deck_moved(self, child, parent, success):
+        if not success:
+            QMessageBox.critical(None, "Error", "A deck can't be moved into one of its own child decks.")
+            return
+        model = self.model()
+        model.move_deck(child, parent)
+        # the due counts of the old and the new parent decks changed
+        model.refresh_counts()
 
     def mouseDoubleClickEvent(self, event):
         index = self.indexAt(event.pos())
         if index.isValid():
-            print("[D] Double-clicked on item at", index.row())
-            self.main_window.study(self.model().data(index, QtCore.Qt.ItemDataRole.DisplayRole))
+            logger.debug("Double-clicked on item at %s", index.row())
+            node = self.model().node(index)
+            self.main_window.study(node.id, node.name)
 
         else:
             super().mouseDoubleClickEvent(event)
 
 
 class LogWriter:
-    @staticmethod
-    def write(message):
-        logging.info(message.strip())
+    """Sends whatever is still written to stdout or stderr (by Qt, a library, an uncaught exception, ...) to the log"""
+    def __init__(self, name):
+        self.logger = logging.getLogger(name)
+
+    def write(self, message):
+        if message.strip():
+            self.logger.info(message.rstrip())
 
     def flush(self):
         pass
 
 
-if __name__ == '__main__':
+def main():
+    """Starts the GUI, only returns once it's closed"""
+    global window
+    from appdata import AppDataPaths
+    app = QApplication(sys.argv)
+    app_paths = AppDataPaths("repetition")
     if app_paths.require_setup:
         app_paths.setup()
 
-    logging.basicConfig(filename=app_paths.log_file_path, level=logging.DEBUG)
-    logging.info(f"New Application startup at {datetime.now()}")
-    sys.stdout = LogWriter()
-    sys.stderr = LogWriter()
+    # debug messages (e.g. every step of the algorithm) are only formatted and written with --debug
+    logconfig.setup(app_paths.log_file_path, logging.DEBUG if "--debug" in sys.argv else logging.INFO)
+    logger.info("New Application startup at %s", datetime.now())
+    sys.stdout = LogWriter("stdout")
+    sys.stderr = LogWriter("stderr")
+
+    profile = "--profile" in sys.argv
+    if profile:
+        import instrumentation
+        instrumentation.enable()
+    window = MainWindow(report_startup_time="--startup-time" in sys.argv, profile=profile)
+    window.resize(600, 500)
+    logger.debug("Main window initialised")
+    logger.debug("calling app.exec")
+    exit_code = app.exec()
+    # previews that weren't rendered yet aren't needed anymore
+    window.preview_worker.shutdown(cancel_pending=True)
+    # an export that's still running is finished first, it still needs the worker
+    window.export_worker.shutdown()
+    # let the worker finish what's queued, then close the db on its thread
+    window.worker.submit(db.close)
+    window.worker.shutdown()
+    if profile:
+        # the event loop is done, so the report is logged here instead of in a callback
+        logger.info("DB statistics:\n%s", instrumentation.report())
+    logconfig.shutdown()
+    return exit_code
 
-    db.connect_DB()
 
-    window = MainWindow()
-    window.resize(600, 500)
-    print("[D] Main window initialised")
-    print("[D] calling app.exec")
-    sys.exit(app.exec())
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,345 @@
+import logging
+
+import db
+
+from PyQt6.QtCore import Qt, QAbstractItemModel, QAbstractListModel, QModelIndex, QMimeData, pyqtSignal
+from PyQt6.QtGui import QFont
+
+'''
+This file contains the item models behind the deck tree and the card list.
+
+Both load their rows lazily through the worker when the view asks for them (canFetchMore/fetchMore) and are changed
+row by row afterwards, so neither of them has to be rebuilt after an action. The decks are shown right away and get
+their due counts, which take longer to count, once the top-level decks are there.
+'''
+
+logger = logging.getLogger(__name__)
+
+# mime type used to drag decks around in the deck tree
+DECK_MIME_TYPE = "application/x-repetition-deck"
+
+
+class DeckNode:
+    __slots__ = ("id", "name", "parent", "children", "due", "total", "child_count", "fetched", "pending")
+
+    def __init__(self, id, name, parent, due=0, total=0, child_count=0):
+        self.id = id
+        self.name = name
+        self.parent = parent
+        self.children = []
+        self.due = due
+        self.total = total
+        # the number of child decks in the db, known before the children themselves are fetched
+        self.child_count = child_count
+        self.fetched = child_count == 0
+        self.pending = False
+
+    def row(self):
+        return self.parent.children.index(self)
+
+
+class DeckTreeModel(QAbstractItemModel):
+    # emitted whenever the due counts were loaded
+    counts_loaded = pyqtSignal()
+
+    def __init__(self, worker):
+        super().__init__()
+        self.worker = worker
+        self.bold_font = QFont()
+        self.bold_font.setBold(True)
+        self.root = DeckNode(None, None, None)
+        self.root.fetched = False
+        # all nodes that are currently loaded, by deck id
+        self.nodes = dict()
+        # the latest (due, total) counts of all decks, also for the ones that aren't loaded yet
+        self.counts = dict()
+
+    # Read access
+    def node(self, index):
+        return index.internalPointer() if index.isValid() else self.root
+
+    def index_of(self, node):
+        if node is self.root:
+            return QModelIndex()
+        return self.createIndex(node.row(), 0, node)
+
+    def index(self, row, column, parent=QModelIndex()):
+        node = self.node(parent)
+        if column != 0 or row < 0 or row >= len(node.children):
+            return QModelIndex()
+        return self.createIndex(row, column, node.children[row])
+
+    def parent(self, index):
+        if not index.isValid():
+            return QModelIndex()
+        return self.index_of(index.internalPointer().parent)
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.column() > 0:
+            return 0
+        return len(self.node(parent).children)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 1
+
+    def hasChildren(self, parent=QModelIndex()):
+        node = self.node(parent)
+        return node is self.root or node.child_count > 0
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if not index.isValid():
+            return None
+        node = index.internalPointer()
+        if role == Qt.ItemDataRole.DisplayRole:
+            return node.name
+        if role == Qt.ItemDataRole.FontRole and node.due:
+            return self.bold_font
+        if role == Qt.ItemDataRole.ToolTipRole:
+            return f"{node.due} of {node.total} cards due"
+        return None
+
+    def headerData(self, section, orientation, role=Qt.ItemDataRole.DisplayRole):
+        if orientation == Qt.Orientation.Horizontal and role == Qt.ItemDataRole.DisplayRole:
+            return "Decks"
+        return None
+
+    def flags(self, index):
+        if not index.isValid():
+            return Qt.ItemFlag.ItemIsDropEnabled
+        return (Qt.ItemFlag.ItemIsEnabled | Qt.ItemFlag.ItemIsSelectable
+                | Qt.ItemFlag.ItemIsDragEnabled | Qt.ItemFlag.ItemIsDropEnabled)
+
+    # Lazy loading
+    def canFetchMore(self, parent):
+        node = self.node(parent)
+        return not node.fetched and not node.pending
+
+    def fetchMore(self, parent):
+        if not self.canFetchMore(parent):
+            return
+        node = self.node(parent)
+        node.pending = True
+        self.worker.submit(db.get_child_decks, node.id, False,
+                           callback=lambda decks: self.on_children_fetched(node, decks))
+
+    def on_children_fetched(self, node, decks):
+        node.pending = False
+        if node is not self.root and self.nodes.get(node.id) is not node:
+            # the node was removed or the model reloaded in the meantime
+            return
+        node.fetched = True
+        node.child_count = len(decks)
+        if decks:
+            logger.debug("Found %s decks under %s", len(decks), node.name)
+            self.beginInsertRows(self.index_of(node), 0, len(decks) - 1)
+            for deck in decks:
+                due, total = self.counts.get(deck["id"], (0, 0))
+                child = DeckNode(deck["id"], deck["name"], node, due, total, deck["children"])
+                node.children.append(child)
+                self.nodes[child.id] = child
+            self.endInsertRows()
+        if node is self.root:
+            self.refresh_counts()
+
+    # Drag and drop
+    def supportedDropActions(self):
+        return Qt.DropAction.MoveAction
+
+    def mimeTypes(self):
+        return [DECK_MIME_TYPE]
+
+    def mimeData(self, indexes):
+        mime_data = QMimeData()
+        if indexes:
+            mime_data.setData(DECK_MIME_TYPE, str(self.node(indexes[0]).id).encode())
+        return mime_data
+
+    # Incremental changes, called once the db was changed
+    def refresh_counts(self):
+        """Reloads the due and total counts and updates the decks whose counts changed"""
+        self.worker.submit(db.get_deck_tree, callback=self.on_counts_loaded)
+
+    def on_counts_loaded(self, decks):
+        self.counts = {deck["id"]: (deck["due"], deck["total"]) for deck in decks}
+        for deck in decks:
+            node = self.nodes.get(deck["id"])
+            if node is not None and (node.due, node.total) != (deck["due"], deck["total"]):
+                node.due, node.total = deck["due"], deck["total"]
+                index = self.index_of(node)
+                self.dataChanged.emit(index, index, [Qt.ItemDataRole.FontRole, Qt.ItemDataRole.ToolTipRole])
+        self.counts_loaded.emit()
+
+    def add_deck(self, deck, name, parent=None):
+        parent_node = self.root if parent is None else self.nodes.get(parent)
+        if parent_node is None:
+            return
+        if not parent_node.fetched:
+            # it's part of the children once they're fetched
+            self.set_child_count(parent_node, parent_node.child_count + 1)
+            return
+        row = len(parent_node.children)
+        self.beginInsertRows(self.index_of(parent_node), row, row)
+        node = DeckNode(deck, name, parent_node)
+        parent_node.children.append(node)
+        parent_node.child_count += 1
+        self.nodes[deck] = node
+        self.endInsertRows()
+
+    def remove_deck(self, deck):
+        node = self.nodes.get(deck)
+        if node is None:
+            return
+        row = node.row()
+        self.beginRemoveRows(self.index_of(node.parent), row, row)
+        node.parent.children.pop(row)
+        node.parent.child_count -= 1
+        self.forget(node)
+        self.endRemoveRows()
+
+    def rename_deck(self, deck, new_name):
+        node = self.nodes.get(deck)
+        if node is None:
+            return
+        node.name = new_name
+        index = self.index_of(node)
+        self.dataChanged.emit(index, index, [Qt.ItemDataRole.DisplayRole])
+
+    def move_deck(self, deck, parent=None):
+        node = self.nodes.get(deck)
+        new_parent = self.root if parent is None else self.nodes.get(parent)
+        if node is None or node.parent is new_parent:
+            return
+        if new_parent is None or not new_parent.fetched:
+            # the deck moves somewhere that isn't loaded (yet), it's enough to take it out here
+            self.remove_deck(deck)
+            if new_parent is not None:
+                self.set_child_count(new_parent, new_parent.child_count + 1)
+            return
+        row = node.row()
+        destination = len(new_parent.children)
+        if not self.beginMoveRows(self.index_of(node.parent), row, row, self.index_of(new_parent), destination):
+            # not a valid move for the view, load everything again
+            self.reload()
+            return
+        node.parent.children.pop(row)
+        node.parent.child_count -= 1
+        node.parent = new_parent
+        new_parent.children.append(node)
+        new_parent.child_count += 1
+        self.endMoveRows()
+
+    def reload(self):
+        """Drops everything that was loaded, the view fetches the top-level decks again"""
+        self.beginResetModel()
+        self.root = DeckNode(None, None, None)
+        self.root.fetched = False
+        self.nodes = dict()
+        self.endResetModel()
+
+    def set_child_count(self, node, child_count):
+        # the views only check whether a deck can be expanded when the layout changes
+        self.layoutAboutToBeChanged.emit()
+        node.child_count = child_count
+        self.layoutChanged.emit()
+
+    def forget(self, node):
+        self.nodes.pop(node.id, None)
+        for child in node.children:
+            self.forget(child)
+
+
+class CardListModel(QAbstractListModel):
+    # emitted with the previous and the new title if a card couldn't be renamed
+    rename_failed = pyqtSignal(str, str)
+    page_size = 200
+
+    def __init__(self, worker, deck):
+        super().__init__()
+        self.worker = worker
+        self.deck = deck
+        # the ids and titles of the loaded cards, row by row
+        self.ids = []
+        self.titles = []
+        # a renamed card can show up again in a later page
+        self.loaded = set()
+        # the title the next page starts after, the last one the db returned (the loaded titles can be renamed since)
+        self.after = None
+        self.has_more = True
+        self.pending = False
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.titles)
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if index.isValid() and role in (Qt.ItemDataRole.DisplayRole, Qt.ItemDataRole.EditRole):
+            return self.titles[index.row()]
+        return None
+
+    def headerData(self, section, orientation, role=Qt.ItemDataRole.DisplayRole):
+        if orientation == Qt.Orientation.Horizontal and role == Qt.ItemDataRole.DisplayRole:
+            return "Cards"
+        return None
+
+    def card_id(self, index):
+        return self.ids[index.row()]
+
+    def flags(self, index):
+        if not index.isValid():
+            return Qt.ItemFlag.NoItemFlags
+        return Qt.ItemFlag.ItemIsEnabled | Qt.ItemFlag.ItemIsSelectable | Qt.ItemFlag.ItemIsEditable
+
+    def canFetchMore(self, parent):
+        return not parent.isValid() and self.has_more and not self.pending
+
+    def fetchMore(self, parent):
+        if not self.canFetchMore(parent):
+            return
+        self.pending = True
+        self.worker.submit(db.get_card_titles, self.deck, self.after, self.page_size, callback=self.on_page_fetched)
+
+    def on_page_fetched(self, cards):
+        self.pending = False
+        self.has_more = len(cards) == self.page_size
+        if cards:
+            self.after = cards[-1][1]
+        cards = [(card, title) for card, title in cards if card not in self.loaded]
+        if not cards:
+            return
+        self.beginInsertRows(QModelIndex(), len(self.titles), len(self.titles) + len(cards) - 1)
+        for card, title in cards:
+            self.ids.append(card)
+            self.titles.append(title)
+            self.loaded.add(card)
+        self.endInsertRows()
+
+    def setData(self, index, value, role=Qt.ItemDataRole.EditRole):
+        if not index.isValid() or role != Qt.ItemDataRole.EditRole:
+            return False
+        card = self.ids[index.row()]
+        previous_title = self.titles[index.row()]
+        if not value or value == previous_title:
+            return False
+        logger.info("Item %s was renamed to %s", previous_title, value)
+        self.worker.submit(db.rename_card, card, value,
+                           callback=lambda success: self.on_card_renamed(card, previous_title, value, success))
+        return True
+
+    def on_card_renamed(self, card, previous_title, new_title, success):
+        if not success:
+            self.rename_failed.emit(previous_title, new_title)
+            return
+        if card in self.loaded:
+            row = self.ids.index(card)
+            self.titles[row] = new_title
+            index = self.index(row)
+            self.dataChanged.emit(index, index, [Qt.ItemDataRole.DisplayRole])
+
+    def remove_card(self, card):
+        if card not in self.loaded:
+            return
+        row = self.ids.index(card)
+        self.beginRemoveRows(QModelIndex(), row, row)
+        self.ids.pop(row)
+        self.titles.pop(row)
+        self.loaded.discard(card)
+        self.endRemoveRows()
@@ -0,0 +1,217 @@
+import logging
+import sys
+import time
+
+import numpy as np
+
+import algorithm
+import db
+import logconfig
+
+'''
+This file fits the parameters of the spaced-repetition algorithm to the review log.
+
+The reviews of all cards are replayed at once: the i-th review of every card is calculated in a single batch, for the
+parameters and for slightly shifted versions of them. That gives the loss and its (numerical) gradient in one pass over
+the log. The loss is the log loss of the retrievability the algorithm predicted for a review against whether the card
+was actually recalled (any grade but "Forgot").
+
+The same replay, with the stabilities rounded like the study page does, reschedules the cards with new parameters.
+'''
+
+logger = logging.getLogger(__name__)
+
+# the predicted retrievability is clipped to [EPSILON, 1 - EPSILON] so the log loss stays finite
+EPSILON = 1e-6
+# stabilities are kept above this while replaying, a stability of 0 doesn't predict anything
+MIN_STABILITY = 0.1
+# relative step of the central differences
+GRADIENT_STEP = 1e-4
+# lower and upper bounds of every parameter, the mean reversion rate and the base of the difficulty factor are rates
+BOUNDS = np.array([
+    (0.0, 1.0),
+    (-10.0, 10.0),
+    (0.01, 1.0),
+    (-5.0, 5.0),
+    (-5.0, 5.0),
+    (-10.0, 10.0),
+    (-5.0, 5.0),
+    (-5.0, 5.0),
+    (-5.0, 5.0),
+])
+
+
+class Histories:
+    """The review log as matrices with one row per card and one column per review, longest histories first"""
+    __slots__ = ("grades", "delta_ts", "initial_stabilities", "initial_difficulties", "lengths", "active", "cards")
+
+    def __init__(self, grades, delta_ts, initial_stabilities, initial_difficulties, lengths, cards):
+        self.grades = grades
+        self.delta_ts = delta_ts
+        # the state of the card before its first logged review, the difficulty is NaN for new cards
+        self.initial_stabilities = initial_stabilities
+        self.initial_difficulties = initial_difficulties
+        self.lengths = lengths
+        # the number of cards with at least i + 1 reviews. As the longest histories come first, those are the first rows
+        self.active = np.searchsorted(-lengths, -np.arange(lengths[0]), side="left")
+        # the id of the card of every row
+        self.cards = cards
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def subset(self, rows):
+        """Returns the histories of the given rows, which have to be in ascending order"""
+        lengths = self.lengths[rows]
+        columns = lengths[0]
+        return Histories(self.grades[rows, :columns], self.delta_ts[rows, :columns], self.initial_stabilities[rows],
+                         self.initial_difficulties[rows], lengths, self.cards[rows])
+
+    @staticmethod
+    def from_review_log(reviews):
+        """Builds the histories from the (card, grade, delta_t, last_interval, last_difficulty) tuples returned by
+        db.get_review_log, which are ordered by card and then by time"""
+        cards, grades, delta_ts, last_intervals, last_difficulties = zip(*reviews)
+        cards = np.array(cards)
+        starts = np.flatnonzero(np.r_[True, cards[1:] != cards[:-1]])
+        lengths = np.diff(np.r_[starts, len(cards)])
+
+        order = np.argsort(-lengths, kind="stable")
+        rank = np.empty_like(order)
+        rank[order] = np.arange(len(order))
+        rows = np.repeat(rank, lengths)
+        columns = np.arange(len(cards)) - np.repeat(starts, lengths)
+
+        grade_matrix = np.ones((len(lengths), lengths.max()), dtype=np.int64)
+        grade_matrix[rows, columns] = grades
+        delta_t_matrix = np.zeros((len(lengths), lengths.max()))
+        delta_t_matrix[rows, columns] = delta_ts
+        initial_stabilities = np.array([last_intervals[i] or 0 for i in starts], dtype=np.float64)[order]
+        initial_difficulties = np.array([last_difficulties[i] for i in starts], dtype=np.float64)[order]
+        return Histories(grade_matrix, delta_t_matrix, initial_stabilities, initial_difficulties, lengths[order],
+                         cards[starts][order])
+
+
+def log_loss(histories, parameter_sets):
+    """Returns the mean log loss of every set of parameters (an array of shape (number of sets, 9)) on the histories"""
+    w = [parameter_sets[:, [i]] for i in range(parameter_sets.shape[1])]
+    new_cards = np.isnan(histories.initial_difficulties)
+    s = np.broadcast_to(histories.initial_stabilities, (len(parameter_sets), len(histories))).copy()
+    d = np.broadcast_to(histories.initial_difficulties, (len(parameter_sets), len(histories))).copy()
+    total = np.zeros(len(parameter_sets))
+    predictions = 0
+
+    for i, active in enumerate(histories.active):
+        s, d = s[:, :active], d[:, :active]
+        grades = histories.grades[:active, i]
+        # only the first review of a card can be the one of a new card
+        new_card = new_cards[:active] if i == 0 else np.zeros(active, dtype=bool)
+        r, s, d = algorithm.next_state_batch(np.maximum(s, MIN_STABILITY), histories.delta_ts[:active, i], d, grades,
+                                             new_card, w)
+
+        # a new card's first review has no prediction to compare to
+        predicted = ~new_card
+        r = np.clip(np.nan_to_num(r[:, predicted], nan=EPSILON), EPSILON, 1 - EPSILON)
+        recalled = grades[predicted] > 1
+        total -= np.where(recalled, np.log(r), np.log1p(-r)).sum(axis=1)
+        predictions += np.count_nonzero(predicted)
+        s = np.nan_to_num(s, nan=MIN_STABILITY, posinf=1e6)
+    return total / max(predictions, 1)
+
+
+def loss_and_gradient(histories, parameters):
+    """Evaluates the loss of the parameters and of all shifted versions in one go"""
+    steps = GRADIENT_STEP * np.maximum(1, np.abs(parameters))
+    shifts = np.diag(steps)
+    losses = log_loss(histories, np.vstack([parameters, parameters + shifts, parameters - shifts]))
+    n = len(parameters)
+    return losses[0], (losses[1:n + 1] - losses[n + 1:]) / (2 * steps)
+
+
+def fit_parameters(reviews, initial=None, iterations=100, learning_rate=0.03, batch_size=1000, seed=0):
+    """Fits the parameters to the reviews (as returned by db.get_review_log) using Adam on random batches of cards.
+    Returns the fitted parameters and their loss on all reviews before and after fitting"""
+    histories = Histories.from_review_log(reviews)
+    initial = np.array(initial or algorithm.DEFAULT_PARAMETERS, dtype=np.float64)
+    parameters = initial.copy()
+    rng = np.random.default_rng(seed)
+    first_moment = np.zeros_like(parameters)
+    second_moment = np.zeros_like(parameters)
+    beta_1, beta_2 = 0.9, 0.999
+
+    for i in range(1, iterations + 1):
+        if len(histories) > batch_size:
+            batch = histories.subset(np.sort(rng.choice(len(histories), batch_size, replace=False)))
+        else:
+            batch = histories
+        loss, gradient = loss_and_gradient(batch, parameters)
+        first_moment = beta_1 * first_moment + (1 - beta_1) * gradient
+        second_moment = beta_2 * second_moment + (1 - beta_2) * gradient ** 2
+        step = learning_rate * (first_moment / (1 - beta_1 ** i)) / (np.sqrt(second_moment / (1 - beta_2 ** i)) + 1e-8)
+        parameters = np.clip(parameters - step, BOUNDS[:, 0], BOUNDS[:, 1])
+        if i % 25 == 0:
+            logger.debug("Iteration %s: loss = %s", i, loss)
+
+    initial_loss, fitted_loss = log_loss(histories, np.vstack([initial, parameters]))
+    if fitted_loss > initial_loss:
+        # random batches can lead astray, never make things worse
+        return tuple(float(w) for w in initial), initial_loss, initial_loss
+    return tuple(float(w) for w in parameters), initial_loss, fitted_loss
+
+
+def replay(histories, parameters=None):
+    """Replays the reviews like the study page did them, but with the given parameters. Returns the stability and
+    difficulty of every card after its last review"""
+    new_cards = np.isnan(histories.initial_difficulties)
+    s = histories.initial_stabilities.astype(np.int64)
+    d = histories.initial_difficulties.copy()
+    for i, active in enumerate(histories.active):
+        # only the first review of a card can be the one of a new card
+        new_card = new_cards[:active] if i == 0 else np.zeros(active, dtype=bool)
+        s[:active], d[:active] = algorithm.calculate_stability_difficulty_batch(
+            s[:active], histories.delta_ts[:active, i], d[:active], histories.grades[:active, i], new_card, parameters)
+    return s, d
+
+
+def reschedule(deck=None):
+    """Recalculates the schedule of every reviewed card (or those of the deck and its child decks) from its reviews
+    with the current parameters. Returns the number of rescheduled cards"""
+    reviews = db.get_review_log(deck)
+    if not reviews:
+        return 0
+    histories = Histories.from_review_log(reviews)
+    s, d = replay(histories, db.get_parameters())
+    last_reviews = db.get_last_review_dates()
+    # due at the last review + the stability, so the study page gets the days since that review right
+    db.set_schedules([(int(card), last_reviews[card] + int(stability), int(stability), float(difficulty))
+                      for card, stability, difficulty in zip(histories.cards, s, d)])
+    logger.info("Rescheduled %s cards", len(histories))
+    return len(histories)
+
+
+def optimize(**kwargs):
+    """Fits the parameters to the review log of the db and stores them for the scheduler. Returns the parameters or
+    None if there are no reviews yet"""
+    reviews = db.get_review_log()
+    if not reviews:
+        logger.info("No reviews logged yet, nothing to fit")
+        return None
+    start = time.perf_counter()
+    parameters, initial_loss, fitted_loss = fit_parameters(reviews, db.get_parameters(), **kwargs)
+    logger.info("Fitted %s reviews in %.1fs, loss %.4f -> %.4f", len(reviews), time.perf_counter() - start,
+                initial_loss, fitted_loss)
+    db.set_parameters(parameters)
+    return parameters
+
+
+if __name__ == '__main__':
+    logconfig.setup()
+    try:
+        db.connect_DB()
+        fitted = optimize()
+        db.close()
+    finally:
+        logconfig.shutdown()
+    if fitted is None:
+        sys.exit(1)
+    print(fitted)
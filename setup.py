@@ -8,7 +8,7 @@ Usage:
 from setuptools import setup
 
 APP = ['main.py']
-DATA_FILES = ["db.py", "algorithm.py"]
+DATA_FILES = ["db.py", "algorithm.py", "worker.py", "models.py", "optimizer.py", "simulate.py", "studyqueue.py", "attachments.py", "thumbnails.py", "archive.py", "importer.py", "cli.py", "instrumentation.py", "logconfig.py"]
 OPTIONS = {}
 
 setup(
@@ -0,0 +1,169 @@
+import argparse
+import logging
+import time
+from datetime import date, timedelta
+
+import numpy as np
+
+import algorithm
+import db
+import logconfig
+
+'''
+This file forecasts the future workload by simulating the reviews of the cards.
+
+The simulation starts from the current state of the cards and plays every day forward: the cards that are due are
+reviewed, their grades are drawn at random and the algorithm schedules them again, exactly like the study page does.
+All runs of the Monte Carlo simulation and all cards due on a day are calculated in a single batch.
+'''
+
+logger = logging.getLogger(__name__)
+
+# used when no grades were logged yet: how often Forgot, Hard, Good and Easy are given
+DEFAULT_GRADE_PROBABILITIES = (0.1, 0.2, 0.55, 0.15)
+# how long practicing a piece takes for every grade, in seconds
+DEFAULT_REVIEW_SECONDS = (600, 420, 300, 180)
+
+
+class Forecast:
+    """The simulated reviews of every run (rows) and day (columns)"""
+    __slots__ = ("start", "reviews", "seconds")
+
+    def __init__(self, start, reviews, seconds):
+        self.start = start
+        self.reviews = reviews
+        self.seconds = seconds
+
+    def __len__(self):
+        return self.reviews.shape[1]
+
+    def rows(self, percentiles=(10, 90)):
+        """Returns one dict per day with the date, the mean and the percentiles of the number of reviews and the mean
+        review time in minutes"""
+        means = self.reviews.mean(axis=0)
+        bounds = np.percentile(self.reviews, percentiles, axis=0)
+        minutes = self.seconds.mean(axis=0) / 60
+        rows = []
+        for day in range(len(self)):
+            row = {"date": (self.start + timedelta(days=day)).isoformat(), "reviews": float(means[day])}
+            for percentile, bound in zip(percentiles, bounds):
+                row[f"p{percentile}"] = float(bound[day])
+            row["minutes"] = float(minutes[day])
+            rows.append(row)
+        return rows
+
+    def table(self):
+        """Returns the rows as a table of text"""
+        lines = [f"{'date':<10} {'reviews':>8} {'p10':>6} {'p90':>6} {'minutes':>8}"]
+        for row in self.rows():
+            lines.append(f"{row['date']:<10} {row['reviews']:>8.1f} {row['p10']:>6.0f} {row['p90']:>6.0f} "
+                         f"{row['minutes']:>8.1f}")
+        return "\n".join(lines)
+
+
+def grade_probabilities():
+    """Returns the share of every grade in the review log, or the default ones if nothing was logged yet"""
+    counts = db.get_grade_counts()
+    if sum(counts) == 0:
+        return DEFAULT_GRADE_PROBABILITIES
+    return tuple(count / sum(counts) for count in counts)
+
+
+def sample_grades(rng, r, new_card, probabilities, use_retrievability):
+    """Draws a grade for every review. With use_retrievability, whether a card is recalled at all is decided by the
+    retrievability the algorithm predicts, and only the grade of a successful recall follows the probabilities"""
+    cumulative = np.cumsum(probabilities)
+    cumulative /= cumulative[-1]
+    u = rng.random(len(r))
+    if not use_retrievability:
+        return np.searchsorted(cumulative, u, side="right") + 1
+    # a new card has no retrievability yet, it's recalled as often as any card is
+    recall_probability = np.where(new_card, 1 - cumulative[0], np.nan_to_num(r))
+    recalled = rng.random(len(r)) < recall_probability
+    # map u into the part of the distribution that belongs to the grades of a successful recall
+    success = cumulative[0] + u * (1 - cumulative[0])
+    grades = np.minimum(np.searchsorted(cumulative, success, side="right") + 1, 4)
+    return np.where(recalled, np.maximum(grades, 2), 1)
+
+
+def simulate(cards, days=30, runs=100, probabilities=None, review_seconds=DEFAULT_REVIEW_SECONDS,
+             use_retrievability=True, parameters=None, seed=None, start=None):
+    """Simulates the reviews of the next days. cards are the (days until due, days since the last review,
+    last_interval, last_difficulty) tuples returned by db.get_card_states. Returns a Forecast"""
+    start = start or date.today()
+    if probabilities is None:
+        probabilities = DEFAULT_GRADE_PROBABILITIES
+    probabilities = np.asarray(probabilities, dtype=np.float64)
+    review_seconds = np.asarray(review_seconds, dtype=np.float64)
+    rng = np.random.default_rng(seed)
+    reviews = np.zeros((runs, days), dtype=np.int64)
+    seconds = np.zeros((runs, days))
+    if not cards:
+        return Forecast(start, reviews, seconds)
+
+    due_in, reviewed_ago, last_intervals, last_difficulties = zip(*cards)
+    # the state of every card in every run, the days are counted from the start
+    due = np.tile(np.array(due_in, dtype=np.int64), (runs, 1))
+    last_review = np.tile(-np.array(reviewed_ago, dtype=np.int64), (runs, 1))
+    s = np.tile(np.array([s or 0 for s in last_intervals], dtype=np.int64), (runs, 1))
+    d = np.tile(np.array(last_difficulties, dtype=np.float64), (runs, 1))
+    new_card = np.isnan(d)
+
+    for day in range(days):
+        # cards that are overdue are all reviewed on the first day
+        run, card = np.nonzero(due <= day)
+        if len(run) == 0:
+            continue
+        card_due, s_i, d_i, new = due[run, card], s[run, card], d[run, card], new_card[run, card]
+        delta_t = day - last_review[run, card]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            r = algorithm.pow_z_batch(0.9, delta_t / np.where(new, 1, s_i))
+        grades = sample_grades(rng, r, new, probabilities, use_retrievability)
+        s_i_p1, d_i_p1 = algorithm.calculate_stability_difficulty_batch(s_i, delta_t, d_i, grades, new, parameters)
+
+        due[run, card] = card_due + s_i_p1
+        last_review[run, card] = day
+        s[run, card] = s_i_p1
+        d[run, card] = d_i_p1
+        new_card[run, card] = False
+        reviews[:, day] = np.bincount(run, minlength=runs)
+        seconds[:, day] = np.bincount(run, weights=review_seconds[grades - 1], minlength=runs)
+    return Forecast(start, reviews, seconds)
+
+
+def forecast(deck=None, fitted_grades=True, **kwargs):
+    """Simulates the reviews of all cards (or those of the deck and its child decks) with the parameters stored in the
+    db. With fitted_grades, the grades are drawn like they were given so far. See simulate for the other arguments"""
+    if fitted_grades and kwargs.get("probabilities") is None:
+        kwargs["probabilities"] = grade_probabilities()
+    if kwargs.get("parameters") is None:
+        kwargs["parameters"] = db.get_parameters()
+    return simulate(db.get_card_states(deck), **kwargs)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Forecasts the daily reviews of the next days")
+    parser.add_argument("--days", type=int, default=30)
+    parser.add_argument("--runs", type=int, default=100)
+    parser.add_argument("--deck", help="only simulate the cards of this deck and its child decks")
+    parser.add_argument("--grades", type=float, nargs=4, metavar=("FORGOT", "HARD", "GOOD", "EASY"),
+                        help="probabilities of the grades instead of the ones in the review log")
+    parser.add_argument("--ignore-retrievability", action="store_true",
+                        help="draw Forgot with its probability instead of from the predicted retrievability")
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args()
+
+    logconfig.setup()
+    try:
+        db.connect_DB()
+        deck = db.get_deck_id(args.deck) if args.deck is not None else None
+        if args.deck is not None and deck is None:
+            raise SystemExit(f"There is no deck named {args.deck}")
+        start_time = time.perf_counter()
+        result = forecast(deck, days=args.days, runs=args.runs, probabilities=args.grades,
+                          use_retrievability=not args.ignore_retrievability, seed=args.seed)
+        db.close()
+        logger.info("Simulated %s runs of %s days in %.1fs", args.runs, args.days, time.perf_counter() - start_time)
+    finally:
+        logconfig.shutdown()
+    print(result.table())
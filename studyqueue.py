@@ -0,0 +1,132 @@
+import heapq
+import logging
+import random
+from datetime import date, timedelta
+
+import algorithm
+import db
+
+'''
+This file contains the queue of the cards studied in a session.
+
+Only the few values needed to order the due cards are read, page by page, and kept in a heap: the cards with the lowest
+retrievability (the most overdue or least stable ones) come first, cards that are equally urgent in random order. The
+full row of a card is only loaded once it's its turn. All methods touch the db and are meant to run on the worker.
+
+schedule calculates what a review means for a card, for the study page as well as for the command line. outcomes does
+the same for all four grades at once, so they can be shown before the card is graded. catch_up spreads a backlog of
+due cards over the next days, in the same order a session would study them.
+'''
+
+logger = logging.getLogger(__name__)
+
+
+def review_state(card, today):
+    """Returns the last stability and difficulty of the card, whether it's new, its due date and the days since it was
+    last studied"""
+    s_i = card.last_interval or 0
+    d_i = card.last_difficulty
+    # a card that was never studied counts from its due date, which is the day it was added
+    last_review = card.last_review if card.last_review is not None else card.next_due_date - s_i
+    delta_t = db.day_number(today) - last_review
+    return s_i, d_i, d_i is None, db.to_date(card.next_due_date), delta_t
+
+
+def schedule(card, grade, today=None):
+    """Runs the algorithm for a review of the card with the grade today. Returns the new stability and difficulty, the
+    next due date and the days since the card was last studied"""
+    s_i, d_i, new_card, next_due_date, delta_t = review_state(card, today or date.today())
+
+    # Run algorithm
+    stability, difficulty = algorithm.calculate_stability_difficulty(s_i, delta_t, d_i, grade, new_card)
+    logger.debug("delta_t = %s, algorithm returned: d_i+1 = %s, s_i+1 = %s", delta_t, difficulty, stability)
+    return stability, difficulty, next_due_date + timedelta(days=stability), delta_t
+
+
+def outcomes(card, today=None):
+    """Runs the algorithm for all four grades at once. Returns what schedule would return for each grade, by grade"""
+    s_i, d_i, new_card, next_due_date, delta_t = review_state(card, today or date.today())
+    return {grade: (stability, difficulty, next_due_date + timedelta(days=stability), delta_t)
+            for grade, (stability, difficulty) in enumerate(algorithm.calculate_all_grades(s_i, delta_t, d_i, new_card),
+                                                            start=1)}
+
+
+def retrievability(last_review, last_interval, new_card, today):
+    """The retrievability the algorithm predicts for a review today, the dates are day numbers. The days since the
+    last review are the delta_t review_state gives the algorithm when the card is graded"""
+    if new_card:
+        # a new card has never been studied, it's as urgent as a card that is due today
+        return 0.9
+    if not last_interval:
+        return 0.0
+    return 0.9 ** ((today - last_review) / last_interval)
+
+
+def catch_up(deck, days):
+    """Spreads the due cards of the deck and its child decks evenly over the given number of days, starting today. The
+    cards with the lowest retrievability stay due the soonest. Returns the number of cards"""
+    if days < 1:
+        raise ValueError("The backlog has to be spread over at least one day")
+    count = db.spread_due_cards(deck, days)
+    logger.info("Spread %s due cards over %s days", count, days)
+    return count
+
+
+class StudyQueue:
+    def __init__(self, limit=None, rng=None):
+        # the maximum number of due cards of a session, cards studied again after "Forgot" don't count
+        self.limit = limit
+        self.rng = rng or random.Random()
+        # entries are (round, retrievability, tie-break, card id), cards graded "Forgot" are studied again a round later
+        self.heap = []
+        # the round of the card that was popped last
+        self.round = 0
+
+    def __len__(self):
+        return len(self.heap)
+
+    def load(self, deck):
+        """Fills the queue with the due cards of the deck and its child decks. Returns their number"""
+        self.heap = []
+        self.round = 0
+        # the counts are checked first, so an empty deck doesn't need to look at any cards
+        if db.get_due_count(deck) == 0:
+            return 0
+        today = db.today()
+        entries = ((0, retrievability(last_review, last_interval, new_card, today), self.rng.random(), card)
+                   for card, last_review, last_interval, new_card in db.iter_due_cards(deck))
+        if self.limit is None:
+            self.heap = list(entries)
+            heapq.heapify(self.heap)
+        else:
+            # only ever keeps the limit most urgent cards in memory
+            self.heap = heapq.nsmallest(self.limit, entries)
+        return len(self.heap)
+
+    def pop(self):
+        """Removes the most urgent card from the queue and returns its row, or None if the queue is empty"""
+        while self.heap:
+            self.round, _, _, card_id = heapq.heappop(self.heap)
+            card = db.get_card(card_id)
+            if card is not None:
+                return card
+            # the card was deleted since the queue was loaded
+        return None
+
+    def pop_with_outcomes(self):
+        """Like pop, but also calculates the outcomes of all grades for the card. Returns (card, outcomes), or
+        (None, None) if the queue is empty"""
+        card = self.pop()
+        if card is None:
+            return None, None
+        return card, outcomes(card)
+
+    def upcoming_files(self, count):
+        """Returns the attached files of the next count cards in the queue, in the order they come up"""
+        # the count smallest entries of a heap are at most count - 1 levels deep, so only those levels are looked at
+        # instead of the whole queue
+        return db.get_card_files(card for *_, card in heapq.nsmallest(count, self.heap[:(1 << count) - 1]))
+
+    def requeue(self, card):
+        """Adds a card (by id) again, it's studied in the next round, after all cards of the current one"""
+        heapq.heappush(self.heap, (self.round + 1, 0.0, self.rng.random(), card))
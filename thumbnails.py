@@ -0,0 +1,125 @@
+import logging
+import os
+import tempfile
+
+from PyQt6.QtCore import QSize, Qt
+from PyQt6.QtGui import QImageReader
+
+import attachments
+import db
+
+try:
+    from PyQt6.QtPdf import QPdfDocument
+except ImportError:
+    # not every PyQt6 install comes with QtPdf, PDFs just don't get a preview then
+    QPdfDocument = None
+
+'''
+This file renders the previews of attached files that are shown on the study page.
+
+The preview of an image is the image itself, the preview of a PDF its first page, both scaled down to PREVIEW_SIZE.
+They're rendered once and cached as PNG files in the app data directory, under the hash of the attached file, so every
+file only has to be rendered once, however many cards use it. The cache is kept below MAX_CACHE_SIZE by removing the
+previews that were used the longest time ago, a preview's modification time is the last time it was used.
+
+Rendering only uses QImage, which (unlike QPixmap) works on any thread, so the previews of the next cards can be
+rendered in the background while the current one is studied.
+'''
+
+logger = logging.getLogger(__name__)
+
+# the folder in the app data directory that holds the previews
+THUMBNAILS_DIR = "thumbnails"
+# the previews fit into this size (in pixels)
+PREVIEW_SIZE = QSize(480, 320)
+MAX_CACHE_SIZE = 100 << 20
+
+
+def has_preview(name):
+    """Whether a preview can be rendered for the stored file, judged by its extension"""
+    extension = os.path.splitext(name)[1].lower()
+    if extension == ".pdf":
+        return QPdfDocument is not None
+    return extension[1:].encode() in {bytes(image_format) for image_format in QImageReader.supportedImageFormats()}
+
+
+def path(name):
+    """Returns the full path of the preview of a stored file, whether it's rendered yet or not"""
+    file_hash = os.path.splitext(os.path.basename(name))[0]
+    return os.path.join(db.get_data_dir(), THUMBNAILS_DIR,
+                        f"{file_hash}_{PREVIEW_SIZE.width()}x{PREVIEW_SIZE.height()}.png")
+
+
+def render_image(source_file):
+    reader = QImageReader(source_file)
+    # photos are often stored rotated, with the rotation in their metadata
+    reader.setAutoTransform(True)
+    size = reader.size()
+    if size.isValid() and (size.width() > PREVIEW_SIZE.width() or size.height() > PREVIEW_SIZE.height()):
+        # decoding straight to the smaller size is a lot faster for large photos
+        reader.setScaledSize(size.scaled(PREVIEW_SIZE, Qt.AspectRatioMode.KeepAspectRatio))
+    return reader.read()
+
+
+def render_pdf(source_file):
+    document = QPdfDocument(None)
+    try:
+        if document.load(source_file) != QPdfDocument.Error.None_ or document.pageCount() == 0:
+            return None
+        page_size = document.pagePointSize(0).scaled(PREVIEW_SIZE.width(), PREVIEW_SIZE.height(),
+                                                     Qt.AspectRatioMode.KeepAspectRatio)
+        return document.render(0, page_size.toSize())
+    finally:
+        document.close()
+
+
+def preview(name):
+    """Returns the path of the preview of a stored file, rendering it first if it isn't cached yet. Returns None if the
+    file has no preview"""
+    if not name or not has_preview(name):
+        return None
+    preview_file = path(name)
+    if os.path.exists(preview_file):
+        # it's the most recently used preview now
+        os.utime(preview_file)
+        return preview_file
+
+    source_file = attachments.path(name)
+    image = render_pdf(source_file) if name.lower().endswith(".pdf") else render_image(source_file)
+    if image is None or image.isNull():
+        logger.warning("No preview could be rendered for %s", name)
+        return None
+    os.makedirs(os.path.dirname(preview_file), exist_ok=True)
+    # like the attached files, a preview only gets its name once it's written completely
+    fd, temporary = tempfile.mkstemp(dir=os.path.dirname(preview_file), suffix=".part")
+    os.close(fd)
+    try:
+        if not image.save(temporary, "PNG"):
+            raise OSError(f"The preview of {name} couldn't be written")
+        os.replace(temporary, preview_file)
+    except BaseException:
+        os.remove(temporary)
+        raise
+    logger.debug("Rendered the preview of %s", name)
+    evict()
+    return preview_file
+
+
+def evict(max_size=MAX_CACHE_SIZE):
+    """Removes the least recently used previews until the cache is no larger than max_size bytes"""
+    try:
+        entries = [entry for entry in os.scandir(os.path.join(db.get_data_dir(), THUMBNAILS_DIR))
+                   if entry.is_file() and entry.name.endswith(".png")]
+    except FileNotFoundError:
+        return
+    stats = [(entry.stat(), entry.path) for entry in entries]
+    size = sum(stat.st_size for stat, _ in stats)
+    for stat, preview_file in sorted(stats, key=lambda item: item[0].st_mtime):
+        if size <= max_size:
+            break
+        try:
+            os.remove(preview_file)
+        except FileNotFoundError:
+            pass
+        size -= stat.st_size
+        logger.debug("Removed %s from the preview cache", os.path.basename(preview_file))
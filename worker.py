@@ -0,0 +1,55 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from PyQt6.QtCore import QObject, Qt, pyqtSignal
+
+'''
+This file moves the database and file system work of the GUI off the GUI thread.
+
+All calls into db.py are run one after another on a single background thread, which is also the only thread the
+connection is ever used from. When a call is done, its result is handed to a callback on the GUI thread.
+
+Exports and the previews of attached files on the study page run on workers of their own (see archive.export_archive
+and thumbnails), so the db calls never have to wait for them. An export only hands its db snapshot to the db's worker.
+'''
+
+logger = logging.getLogger(__name__)
+
+
+class Worker(QObject):
+    # emitted from the background thread with the finished future and its callbacks
+    finished = pyqtSignal(object, object, object)
+
+    def __init__(self, name="db"):
+        super().__init__()
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=name)
+        # always queue, so the callbacks run on the GUI thread after submit returned, even for calls that are already done
+        self.finished.connect(self.on_finished, Qt.ConnectionType.QueuedConnection)
+
+    def submit(self, fn, *args, callback=None, error_callback=None, **kwargs):
+        """Runs fn(*args, **kwargs) on the background thread. Calls are run in the order they were submitted.
+        Once done, callback is called on the GUI thread with the result, or error_callback with the exception"""
+        future = self.executor.submit(fn, *args, **kwargs)
+        future.add_done_callback(lambda f: self.finished.emit(f, callback, error_callback))
+        return future
+
+    def call(self, fn, *args, **kwargs):
+        """Runs fn(*args, **kwargs) on the background thread and waits for its result. Only for other background threads,
+        the GUI thread would freeze while waiting"""
+        return self.executor.submit(fn, *args, **kwargs).result()
+
+    @staticmethod
+    def on_finished(future, callback, error_callback):
+        error = future.exception()
+        if error is not None:
+            if error_callback is not None:
+                error_callback(error)
+            else:
+                logger.error("Background call failed: %r", error, exc_info=error)
+        elif callback is not None:
+            callback(future.result())
+
+    def shutdown(self, cancel_pending=False):
+        """Waits for all submitted calls to finish (or only the running one, with cancel_pending) and stops the
+        background thread"""
+        self.executor.shutdown(wait=True, cancel_futures=cancel_pending)